@@ -0,0 +1,202 @@
+"""Benchmark of the read -> process -> analyze pipeline on synthetic decklists
+
+Generates seeded synthetic Premodern-style decklists (60 main + 15 sideboard) in the txt layout written by the
+downloader, times each stage and its inner helpers (wall time and peak memory, from the spans of the
+instrumentation module) and saves a json report that can be compared with the report of another version:
+
+    python 1_utils/benchmark.py --sizes 100 1000 10000 100000 --output bench.json
+    python 1_utils/benchmark.py --sizes 100 1000 --output new.json --compare bench.json
+
+Everything runs in a temporary folder with a copy of the cards database, so the real data is never modified.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+import functions
+import cards_db
+import instrumentation
+import result_cache
+
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+deck_name = "Synthetic Deck"
+format = "Premodern"
+basic_lands = {"W": "Plains", "U": "Island", "B": "Swamp", "R": "Mountain", "G": "Forest"}
+
+
+def generate_decklists(path, n_decks, pool_size=300, color_spread=3, seed=0):
+    """Write n_decks synthetic decklists to 'path' in the txt layout of the downloader
+
+    Cards are real Premodern cards of the cards database. The archetype plays 'color_spread' colors: every deck
+    plays the first one and splashes each of the others with probability 0.5. 'pool_size' spells of those colors
+    are played by the archetype, with a few popular core cards and a long tail of flex cards.
+    """
+    rnd = random.Random(seed)
+    with open(os.path.join(repo_path, "0_data", "cards_database.json"), "r") as file:
+        cards_database = json.load(file)["premodern"]
+    colors = rnd.sample("WUBRG", color_spread)
+    spells, lands = [], []
+    for name, attributes in sorted(cards_database.items()):
+        card_colors = attributes.get("color")
+        if not isinstance(card_colors, str) or card_colors == "unknown" or name != name.strip():
+            continue
+        if attributes.get("type") == "Land":
+            lands.append(name)
+        elif set(card_colors.replace("C", "")) <= set(colors):
+            spells.append((name, set(card_colors.replace("C", ""))))
+    rnd.shuffle(spells)
+    spells = spells[:pool_size]
+    # Zipf-like popularity, so that the first cards of the pool are played by most decks
+    weights = [1 / (i + 1) for i in range(len(spells))]
+
+    os.makedirs(path, exist_ok=True)
+    digits_len = len(str(n_decks))
+    for i in range(n_decks):
+        deck_colors = {colors[0]} | {color for color in colors[1:] if rnd.random() < 0.5}
+        playable = [(j, name) for j, (name, card_colors) in enumerate(spells) if card_colors <= deck_colors]
+        main, sideboard = {}, {}
+        n_main = 0
+        while n_main < 36 and len(main) < len(playable):
+            j, name = rnd.choices(playable, weights=[weights[j] for j, _ in playable])[0]
+            if name not in main:
+                main[name] = min(rnd.choice([1, 2, 3, 4, 4, 4]), 36 - n_main)
+                n_main += main[name]
+        for name in rnd.sample(lands, min(4, len(lands))):
+            main[name] = rnd.randint(1, 4)
+            n_main += main[name]
+        basics = [basic_lands[color] for color in deck_colors]
+        while n_main < 60:
+            name = rnd.choice(basics)
+            main[name] = main.get(name, 0) + 1
+            n_main += 1
+        n_sideboard = 0
+        while n_sideboard < 15:
+            j, name = rnd.choice(playable)
+            qty = min(rnd.randint(1, 4), 15 - n_sideboard)
+            if sideboard.get(name, 0) + qty <= 4:
+                sideboard[name] = sideboard.get(name, 0) + qty
+                n_sideboard += qty
+        lines = [f"{qty} {name}" for name, qty in main.items()] + [""] + [f"{qty} {name}" for name, qty in sideboard.items()]
+        with open(os.path.join(path, f"decklist_{str(i).zfill(digits_len)}.txt"), "w") as f:
+            f.write(("\r\n".join(lines) + "\r\n").replace("\n", ""))
+
+
+def _run_pipeline():
+    """Run read -> process -> analyze of the synthetic deck, returning the number of decklists and of partitions"""
+    df = functions.read_decklists(deck_name, format)
+    dfs = functions.process_decklists(df, format)
+    for df_color in dfs:
+        functions.analyze_dls(df_color)
+    return len(df["#dl"].unique()), len(dfs)
+
+
+def run_benchmark(sizes, pool_size=300, color_spread=3, seed=0, trace_memory=True):
+    """Benchmark the pipeline for each number of decklists in 'sizes' and return the report as a dict"""
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "params": {"pool_size": pool_size, "color_spread": color_spread, "seed": seed},
+        "results": [],
+        "counters": [],
+    }
+    cwd = os.getcwd()
+    # Every run must compute its results
+    cache_enabled, result_cache.enabled = result_cache.enabled, False
+    for n_decks in sizes:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            # Work on a copy of the cards database, paths of the pipeline are relative to the repo root
+            os.makedirs(os.path.join(tmp_path, "0_data"))
+            for file in ["cards_database.json", "cards_database.xlsx"]:
+                shutil.copy(os.path.join(repo_path, "0_data", file), os.path.join(tmp_path, "0_data", file))
+            decklists_path = os.path.join(tmp_path, functions.base_path, format.lower(), deck_name.lower().replace(" ", "_"))
+            start = time.perf_counter()
+            generate_decklists(decklists_path, n_decks, pool_size=pool_size, color_spread=color_spread, seed=seed)
+            print(f"{n_decks} decklists generated in {time.perf_counter() - start:.2f}s")
+            os.chdir(tmp_path)
+            stage_spans = {}
+            try:
+                # Time without tracing memory, then measure memory in a second run from a fresh copy
+                for trace in [False, True] if trace_memory else [False]:
+                    shutil.rmtree(os.path.join(decklists_path, "store"), ignore_errors=True)
+                    for file in os.listdir("0_data"):
+                        if file.startswith("cards_database.sqlite"):
+                            os.remove(os.path.join("0_data", file))
+                    cards_db._cache.clear()
+                    with instrumentation.capture(memory=trace):
+                        n_dls, n_partitions = _run_pipeline()
+                    metrics = instrumentation.summary()
+                    if trace:
+                        for name, record in metrics["spans"].items():
+                            stage_spans.setdefault(name, dict(record))["peak_mb"] = record["peak_mb"]
+                    else:
+                        stage_spans.update(metrics["spans"])
+                        report["counters"].append({"n_decks": n_decks, **metrics["counters"]})
+            finally:
+                os.chdir(cwd)
+        for name, record in stage_spans.items():
+            report["results"].append({"n_decks": n_decks, "n_partitions": n_partitions, "name": name, **record})
+            print(f"\t{name:<24} calls {record['calls']:>6}  wall {record['wall_s']:>9.4f}s  peak {record['peak_mb']:>9.1f}MB")
+    result_cache.enabled = cache_enabled
+    return report
+
+
+def compare_reports(report, baseline, threshold=1.2):
+    """Print the wall time ratio of each (n_decks, name) of report over baseline and return the regressions"""
+    baseline_results = {(r["n_decks"], r["name"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\nComparison with {baseline.get('commit')} (ratio new / old, regression above {threshold}):")
+    for result in report["results"]:
+        old = baseline_results.get((result["n_decks"], result["name"]))
+        if old is None or not old["wall_s"]:
+            continue
+        ratio = result["wall_s"] / old["wall_s"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"\t{result['n_decks']:>7} {result['name']:<24} wall {ratio:>6.2f}x  peak {result['peak_mb']:.1f}MB vs {old['peak_mb']:.1f}MB{flag}")
+        if ratio > threshold:
+            regressions.append(result)
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_path,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the read -> process -> analyze pipeline on synthetic decklists")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="numbers of decklists")
+    parser.add_argument("--pool-size", type=int, default=300, help="number of distinct spells of the archetype")
+    parser.add_argument("--color-spread", type=int, default=3, choices=range(1, 6), help="number of colors of the archetype")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="do not measure peak memory (faster)")
+    parser.add_argument("--output", default="bench_output.json", help="json report path")
+    parser.add_argument("--compare", help="json report of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2, help="wall time ratio flagged as a regression")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.sizes, pool_size=args.pool_size, color_spread=args.color_spread, seed=args.seed,
+                           trace_memory=not args.no_memory)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport saved to '{args.output}'")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare_reports(report, json.load(f), threshold=args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,220 @@
+import os
+import json
+import hashlib
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+from instrumentation import count, timed
+
+
+# Cards database, an indexed SQLite table of (format, name) -> type, subtype, color.
+# cards_database.json (curated in database_management.ipynb) and cards_database.xlsx are its sources: they
+# are imported again whenever their mtime changes, json values taking precedence over the excel ones.
+# Cards seen for the first time are added as 'unknown' to both the table and cards_database.json, so that they
+# show up for curation in the notebook, whose edits of the json are then imported back.
+cards_db_path = os.path.join("0_data", "cards_database.sqlite")
+cards_db_json_path = os.path.join("0_data", "cards_database.json")
+cards_db_excel_path = os.path.join("0_data", "cards_database.xlsx")
+columns = ["type", "subtype", "color"]
+
+# Cards of each (database path, format) loaded in this process, with the file mtimes they were loaded at
+_cache = {}
+# Version hash of the cards of each (database path, format), with the cards it was computed from
+_versions = {}
+
+
+def _connect(db_path):
+    """Connect to the database in WAL mode, waiting for the locks of other processes instead of failing"""
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    # WAL mode is persistent, it only has to be set once. Setting it does not wait for busy locks, so retry
+    # while other processes are creating the database at the same time
+    for attempt in range(100):
+        try:
+            if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+                conn.execute("PRAGMA journal_mode=WAL")
+            break
+        except sqlite3.OperationalError:
+            time.sleep(0.05 * (attempt + 1))
+    conn.execute("""CREATE TABLE IF NOT EXISTS cards (
+                        format TEXT, name TEXT, type TEXT, subtype TEXT, color TEXT,
+                        PRIMARY KEY (format, name))""")
+    conn.execute("CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime INTEGER)")
+    return conn
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+
+def _db_mtime(db_path):
+    """Last modification of the database, whose recent writes live in the -wal file"""
+    return (_mtime(db_path), _mtime(db_path + "-wal"))
+
+
+def _sync_sources(db_path, json_path, excel_path):
+    """Import the json and excel sources into the database if they changed since they were last imported"""
+    sources = {json_path: _mtime(json_path), excel_path: _mtime(excel_path)}
+    conn = _connect(db_path)
+    try:
+        imported = dict(conn.execute("SELECT path, mtime FROM sources").fetchall())
+        if all(imported.get(path) == mtime for path, mtime in sources.items() if mtime is not None):
+            return
+        # Take the write lock and check again, another process may have imported the sources meanwhile
+        conn.execute("BEGIN IMMEDIATE")
+        imported = dict(conn.execute("SELECT path, mtime FROM sources").fetchall())
+        if sources[json_path] is not None and imported.get(json_path) != sources[json_path]:
+            with open(json_path, "r") as file:
+                cards_database = json.load(file)
+            rows = [(format, name, *(_to_sql(attributes.get(column)) for column in columns))
+                    for format, cards in cards_database.items() for name, attributes in cards.items()]
+            conn.executemany("""INSERT INTO cards VALUES (?, ?, ?, ?, ?)
+                                ON CONFLICT (format, name) DO UPDATE
+                                SET type=excluded.type, subtype=excluded.subtype, color=excluded.color""", rows)
+        if sources[excel_path] is not None and imported.get(excel_path) != sources[excel_path]:
+            cards_db_excel = pd.read_excel(excel_path)
+            rows = [tuple(_to_sql(value) for value in row) for row in cards_db_excel.itertuples(index=False)]
+            conn.executemany("INSERT OR IGNORE INTO cards VALUES (?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT OR REPLACE INTO sources VALUES (?, ?)",
+                         [(path, mtime) for path, mtime in sources.items() if mtime is not None])
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _to_sql(value):
+    """Missing values (NaN) are stored as NULL"""
+    return None if value is None or (isinstance(value, float) and np.isnan(value)) else value
+
+
+@timed
+def load_cards_db(format, db_path=cards_db_path, json_path=cards_db_json_path, excel_path=cards_db_excel_path):
+    """Cards of a format as a DataFrame indexed by name with columns 'type', 'subtype' and 'color'
+
+    The cards are loaded once per process and reloaded only when the database file (or one of its sources)
+    has been modified since, e.g. by another process.
+    """
+    key = (db_path, format)
+    mtimes = (_db_mtime(db_path), _mtime(json_path), _mtime(excel_path))
+    if key in _cache and _cache[key][0] == mtimes:
+        return _cache[key][1]
+    count("cards_db_loads")
+    _sync_sources(db_path, json_path, excel_path)
+    conn = _connect(db_path)
+    try:
+        cards = pd.read_sql_query("SELECT name, type, subtype, color FROM cards WHERE format = ?", conn, params=(format,))
+    finally:
+        conn.close()
+    cards = cards.set_index("name")
+    cards = cards.where(cards.notna(), np.nan)
+    _cache[key] = ((_db_mtime(db_path), _mtime(json_path), _mtime(excel_path)), cards)
+    return cards
+
+
+@timed
+def add_missing_cards(format, names, db_path=cards_db_path, json_path=cards_db_json_path, excel_path=cards_db_excel_path):
+    """Add the card names not yet in the database with 'unknown' type, subtype and color, in a single batch
+
+    The new names are also added to the json source, rewritten once per batch, for curation. Returns the number
+    of cards added. Nothing is written when every name is already known.
+    """
+    cards = load_cards_db(format, db_path, json_path, excel_path)
+    new_names = pd.Index(pd.unique(np.asarray(names, dtype=object))).difference(cards.index)
+    if new_names.empty:
+        return 0
+    conn = _connect(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # Names added meanwhile by another process are ignored, rowcount only counts the inserted ones
+        n_added = conn.executemany("INSERT OR IGNORE INTO cards VALUES (?, ?, 'unknown', 'unknown', 'unknown')",
+                                   [(format, name) for name in new_names]).rowcount
+        # Under the write lock of the database, so that concurrent processes do not overwrite each other's names
+        if n_added and _add_to_json(json_path, format, new_names):
+            conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (json_path, _mtime(json_path)))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    # Reload so that the cache also gets the cards added concurrently by other processes
+    _cache.pop((db_path, format), None)
+    load_cards_db(format, db_path, json_path, excel_path)
+    count("cards_added", n_added)
+    return n_added
+
+
+def _add_to_json(json_path, format, names):
+    """Add the names missing from the json source as 'unknown' cards, returning whether the file was rewritten"""
+    cards_database = {}
+    if os.path.exists(json_path):
+        with open(json_path, "r") as file:
+            cards_database = json.load(file)
+    cards = cards_database.setdefault(format, {})
+    new_names = [name for name in names if name not in cards]
+    if not new_names:
+        return False
+    for name in new_names:
+        cards[name] = {column: "unknown" for column in columns}
+    tmp_path = f"{json_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(cards_database, file)
+    os.replace(tmp_path, json_path)
+    return True
+
+
+@timed
+def lookup_cards(format, names, columns=columns, db_path=cards_db_path, json_path=cards_db_json_path, excel_path=cards_db_excel_path):
+    """Vectorized lookup of the attributes of an array of card names
+
+    Each distinct name is looked up once in the index of the cached cards. Returns a tuple with one object
+    array per requested column, aligned with 'names' and NaN for the names not in the database.
+    """
+    cards = load_cards_db(format, db_path, json_path, excel_path)
+    codes, uniques = pd.factorize(np.asarray(names, dtype=object))
+    count("cards_looked_up", len(uniques))
+    positions = cards.index.get_indexer(uniques)
+    found = positions >= 0
+    results = []
+    for column in columns:
+        values = np.full(len(uniques), np.nan, dtype=object)
+        values[found] = cards[column].to_numpy(dtype=object)[positions[found]]
+        results.append(values[codes])
+    return tuple(results)
+
+
+def cards_version(format, db_path=cards_db_path, json_path=cards_db_json_path, excel_path=cards_db_excel_path):
+    """Hash of the cards of a format, changing whenever a card is added or its attributes are modified
+
+    Cards whose type, subtype and color are all 'unknown' are left out: process_decklists gives the same result
+    for a card added as 'unknown' and for a card missing from the database, which it adds as 'unknown'.
+    """
+    key = (db_path, format)
+    cards = load_cards_db(format, db_path, json_path, excel_path)
+    if key in _versions and _versions[key][0] is cards:
+        return _versions[key][1]
+    known = cards[~(cards[columns] == "unknown").all(axis=1)].sort_index()
+    version = hashlib.sha256(pd.util.hash_pandas_object(known, index=True).to_numpy().tobytes()).hexdigest()
+    _versions[key] = (cards, version)
+    return version
+
+
+def export_json(json_path=cards_db_json_path, db_path=cards_db_path, excel_path=cards_db_excel_path):
+    """Write the whole database, including the cards added as 'unknown', to the json file curated by hand"""
+    _sync_sources(db_path, json_path, excel_path)
+    conn = _connect(db_path)
+    try:
+        rows = conn.execute("SELECT format, name, type, subtype, color FROM cards").fetchall()
+    finally:
+        conn.close()
+    cards_database = {}
+    for format, name, *attributes in rows:
+        cards_database.setdefault(format, {})[name] = {column: np.nan if value is None else value
+                                                       for column, value in zip(columns, attributes)}
+    with open(json_path, "w") as file:
+        json.dump(cards_database, file)
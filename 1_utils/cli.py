@@ -0,0 +1,155 @@
+"""Command line entry point of the pipeline, to be run from the root of the repository
+
+    python 1_utils/cli.py download "Devourer Combo" Premodern
+    python 1_utils/cli.py process "Devourer Combo" Premodern --output-format parquet
+    python 1_utils/cli.py analyze "Devourer Combo" Premodern --incremental --output-dir output
+    python 1_utils/cli.py report "Devourer Combo" Premodern
+
+Each subcommand only imports the modules it needs, the heavy ones (pandas, numpy, scipy, requests) when it runs,
+so '--help' and download-only runs start fast.
+"""
+import os
+import sys
+import argparse
+import importlib.util
+
+
+output_formats = ["csv", "json", "parquet"]
+
+
+def _output_path(args, deck_colors, kind):
+    """'<output_dir>/<format>/<deck>/<deck_colors>_<kind>.<ext>', as written by analyze_batch"""
+    path = os.path.join(args.output_dir, args.format.lower().replace(" ", "_"), args.deck.lower().replace(" ", "_"))
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, f"{deck_colors or 'C'}_{kind}.{args.output_format}")
+
+
+def _write(df, path, output_format):
+    if output_format == "csv":
+        df.to_csv(path, index=False)
+    elif output_format == "json":
+        df.to_json(path, orient="records", indent=1)
+    else:
+        df.to_parquet(path, index=False)
+    print(f"Saved '{path}'")
+
+
+def _label(df):
+    """Name of a partition in the output files: its deck colors, prefixed by its cluster for cluster partitions"""
+    deck_colors = df["deck_colors"].iloc[0]
+    return f"cluster{df['cluster'].iloc[0]}_{deck_colors or 'C'}" if "cluster" in df.columns else deck_colors
+
+
+def _partitions(args):
+    """dfs of the color partitions, or of the cluster partitions with '--clusters'"""
+    import functions
+    df = functions.read_decklists(args.deck, args.format, skip_duplicates=args.skip_duplicates)
+    dfs = functions.process_decklists(df, args.format)
+    if args.clusters is not None:
+        dfs = functions.cluster_partitions(dfs, threshold=args.clusters, min_size=args.min_cluster_size)
+    return dfs
+
+
+def _analyze(args):
+    """df_types and df_cards of each partition, as a dict {deck_colors: (df_types, df_cards)}"""
+    import functions
+    if args.incremental:
+        return functions.update_analysis(args.deck, args.format)
+    return {_label(df): functions.analyze_dls(df) for df in _partitions(args)}
+
+
+def download(args):
+    from downloader import download_decklists
+    download_decklists(args.deck, args.format, n_pages=args.pages, max_workers=args.workers, rate_limit=args.rate_limit,
+                       retries=args.retries, url=args.url, stop_at_known=args.stop_at_known,
+                       flag_duplicates=args.flag_duplicates, duplicate_threshold=args.duplicate_threshold)
+
+
+def process(args):
+    for df in _partitions(args):
+        _write(df, _output_path(args, _label(df), "decklists"), args.output_format)
+
+
+def analyze(args):
+    for deck_colors, (df_types, df_cards) in _analyze(args).items():
+        _write(df_types, _output_path(args, deck_colors, "types"), args.output_format)
+        _write(df_cards, _output_path(args, deck_colors, "cards"), args.output_format)
+
+
+def report(args):
+    """Print the final decklist of each color partition with at least --min-decks decklists"""
+    for deck_colors, (df_types, df_cards) in _analyze(args).items():
+        n_decks = int(df_types["n_dls"].iloc[0]) if len(df_types) else 0
+        if n_decks < args.min_decks:
+            continue
+        print(f"### {args.deck} ({args.format}), {'' if deck_colors.startswith('cluster') else 'colors '}{deck_colors or 'C'}: {n_decks} decklists")
+        for sb, title in [(0, "Main deck"), (1, "Sideboard")]:
+            df = df_cards[(df_cards["sb"] == sb) & (df_cards["final_qty"] > 0)]
+            print(f"{title} ({int(df['final_qty'].sum())})")
+            for qty, name in zip(df["final_qty"], df["name"]):
+                print(f"{int(qty)} {name}")
+        print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="cli.py", description="Download, process and analyze MTG decklists")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def _add_parser(name, func, help):
+        subparser = subparsers.add_parser(name, help=help, description=help)
+        subparser.add_argument("deck", help="deck archetype, e.g. 'Devourer Combo'")
+        subparser.add_argument("format", help="format, e.g. 'Premodern'")
+        subparser.add_argument("--metrics", help="append the instrumentation metrics of the run to this json lines file")
+        subparser.set_defaults(func=func)
+        return subparser
+
+    subparser = _add_parser("download", download, "download the new decklists of an archetype from tcdecks")
+    subparser.add_argument("--pages", type=int, help="maximum number of listing pages (all by default)")
+    subparser.add_argument("--workers", type=int, default=8, help="concurrent requests")
+    subparser.add_argument("--rate-limit", type=float, default=5, help="requests per second, 0 to disable")
+    subparser.add_argument("--retries", type=int, default=3)
+    subparser.add_argument("--stop-at-known", action="store_true",
+                           help="stop the listing at the first page whose decklists are all downloaded")
+    subparser.add_argument("--url", default="https://www.tcdecks.net", help="root of the site")
+    subparser.add_argument("--flag-duplicates", action="store_true", help="flag the near-duplicate decklists in the manifest")
+    subparser.add_argument("--duplicate-threshold", type=float, default=0.9,
+                           help="similarity of the cards above which a decklist is a near-duplicate")
+
+    def _add_partition_arguments(subparser):
+        subparser.add_argument("--skip-duplicates", action="store_true",
+                               help="leave out the decklists flagged as near-duplicates by 'download --flag-duplicates'")
+        subparser.add_argument("--clusters", type=float, metavar="THRESHOLD",
+                               help="partition the decklists by variant, clustering them at this similarity, instead of by colors")
+        subparser.add_argument("--min-cluster-size", type=int, default=2, help="smaller clusters are pooled as cluster -1")
+
+    for name, func, help in [("process", process, "split the decklists of an archetype by deck colors"),
+                             ("analyze", analyze, "compute the types and cards statistics of each color partition")]:
+        subparser = _add_parser(name, func, help)
+        subparser.add_argument("--output-dir", default="output", help="root folder of the output files")
+        subparser.add_argument("--output-format", choices=output_formats, default="csv")
+        _add_partition_arguments(subparser)
+        if name == "analyze":
+            subparser.add_argument("--incremental", action="store_true",
+                                   help="only fold the new decklists into the saved partition states")
+
+    subparser = _add_parser("report", report, "print the final decklist of each color partition")
+    subparser.add_argument("--min-decks", type=int, default=1, help="skip partitions with fewer decklists")
+    _add_partition_arguments(subparser)
+    subparser.add_argument("--incremental", action="store_true",
+                           help="only fold the new decklists into the saved partition states")
+
+    args = parser.parse_args(argv)
+    if getattr(args, "output_format", None) == "parquet" and not any(importlib.util.find_spec(engine) for engine in ["pyarrow", "fastparquet"]):
+        parser.error("parquet output requires pyarrow or fastparquet")
+    if getattr(args, "incremental", False) and (args.clusters is not None or args.skip_duplicates):
+        parser.error("--incremental works on the color partitions of all the decklists, without --clusters or --skip-duplicates")
+    if args.metrics is None:
+        args.func(args)
+        return
+    import instrumentation
+    with instrumentation.capture(args.metrics):
+        args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+import hashlib
+import numpy as np
+from instrumentation import count, span, timed
+
+
+# MinHash signatures of decklists and LSH over them, to find near-duplicate decklists and cluster the variants of
+# an archetype without comparing every pair of decklists. A decklist is the set of its (sb, name, copy) tokens,
+# e.g. "4 Brainstorm" in the main deck gives the tokens (0, Brainstorm, 1) ... (0, Brainstorm, 4), so the Jaccard
+# similarity of two decklists is that of their card multisets. The similarity is estimated by the share of equal
+# values of their signatures, the minimum hash of their tokens under each of 'num_perm' hash functions.
+num_perm = 128
+# Number of tokens hashed at a time, bounds the memory used by minhash_signatures to about 4 * num_perm bytes each
+chunk_size = 200_000
+# Share of the pairs of a given similarity that LSH should propose as candidates, see lsh_params
+min_recall = 0.95
+# Buckets of at most max_bucket decklists have all their pairs verified. In larger buckets (e.g. hundreds of copies
+# of a list) each decklist is only compared with the next one, which keeps the bucket connected for clustering
+max_bucket = 50
+
+
+def _mix(x):
+    """splitmix64 finalizer, a fast and well distributed hash of uint64 arrays"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+@timed
+def minhash_signatures(deck_offsets, card_ids, qty, sb, names, num_perm=num_perm, seed=0):
+    """MinHash signatures of decklists given in the layout of the columnar store (see decklist_store)
+
+    Rows of decklist i are deck_offsets[i]:deck_offsets[i+1] of the card_ids (indexes in 'names'), qty and sb
+    arrays. Card names are hashed by content, so signatures computed with the same 'num_perm' and 'seed' can be
+    compared across stores. Returns a uint32 array of shape (n_decks, num_perm), decklists without cards having
+    a signature of maximum values.
+    """
+    deck_offsets = np.asarray(deck_offsets, dtype=np.int64)
+    qty = np.maximum(np.asarray(qty, dtype=np.int64), 0)
+    n_decks = len(deck_offsets) - 1
+    signatures = np.full((n_decks, num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+
+    # Distinct tokens (card, sb, copy) of the rows, the copies of a row being numbered 0 to qty - 1
+    rows = np.repeat(np.arange(len(qty)), qty)
+    copies = np.arange(len(rows)) - np.repeat(np.cumsum(qty) - qty, qty)
+    max_copies = int(qty.max()) if len(qty) else 1
+    keys = (np.asarray(card_ids, dtype=np.int64)[rows] * 2 + np.asarray(sb, dtype=np.int64)[rows]) * max_copies + copies
+    tokens, token_ids = np.unique(keys, return_inverse=True)
+
+    # Hash of each distinct token under each hash function h(x) = high 32 bits of (a * x + b) mod 2^64
+    name_hashes = np.array([int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little") for name in names],
+                           dtype=np.uint64)
+    token_cards, token_copies = np.divmod(tokens, max_copies)
+    token_hashes = _mix(name_hashes[token_cards // 2] ^ _mix((token_cards % 2 * 64 + token_copies).astype(np.uint64)))
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 2**63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+    # Plus a padding token hashing to the maximum value
+    hashes = np.full((len(tokens) + 1, num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    hashes[:-1] = (token_hashes[:, None] * a + b) >> np.uint64(32)
+
+    # Minimum hash of the tokens of each decklist, by chunks of decklists whose tokens are padded to the same length
+    token_offsets = np.r_[0, np.cumsum(qty)][deck_offsets]
+    token_ids = np.r_[token_ids, len(tokens)]
+    lengths = np.diff(token_offsets)
+    step = max(1, chunk_size // max(int(lengths.mean()) if n_decks else 1, 1))
+    for start in range(0, n_decks, step):
+        chunk = slice(start, start + step)
+        positions = token_offsets[:-1][chunk][:, None] + np.arange(lengths[chunk].max(initial=0))
+        positions[positions >= token_offsets[1:][chunk][:, None]] = len(token_ids) - 1
+        signatures[chunk] = hashes[token_ids[positions]].min(axis=1, initial=np.iinfo(np.uint32).max)
+    count("signatures", n_decks)
+    return signatures
+
+
+def lsh_params(num_perm, threshold):
+    """(bands, rows) of the LSH index: the signatures are cut into 'bands' bands of 'rows' values, and decklists
+    sharing all the values of a band are candidates. A pair of similarity s is a candidate with probability
+    1 - (1 - s^rows)^bands, the most rows (the fewest false candidates) such that pairs of similarity 'threshold'
+    are candidates with probability 'min_recall' are taken."""
+    params = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    recalls = [1 - (1 - threshold ** rows) ** bands for bands, rows in params]
+    return max([param for param, recall in zip(params, recalls) if recall >= min_recall] or params[:1], key=lambda param: param[1])
+
+
+def _bucket_pairs(keys, n_decks):
+    """Candidate pairs a * n_decks + b of the decklists sharing a bucket key: all the pairs of the buckets of at
+    most max_bucket decklists, the pairs of consecutive decklists of the larger ones"""
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(keys)])
+    # Position of each decklist in its bucket, and number of decklists after it in the bucket
+    buckets = np.repeat(np.arange(len(starts)), sizes)
+    remaining = sizes[buckets] - (np.arange(len(keys)) - starts[buckets]) - 1
+    remaining[sizes[buckets] > max_bucket] = np.minimum(remaining[sizes[buckets] > max_bucket], 1)
+    pairs = []
+    for offset in range(1, int(remaining.max(initial=0)) + 1):
+        first = np.flatnonzero(remaining >= offset)
+        pairs.append(order[first] * n_decks + order[first + offset])
+    return np.concatenate(pairs) if pairs else np.empty(0, dtype=np.int64)
+
+
+@timed
+def similar_pairs(signatures, threshold):
+    """Pairs of decklists (rows of 'signatures') with an estimated similarity of at least 'threshold'
+
+    Each band of the signatures is hashed to a bucket key and the pairs of decklists sharing a bucket are
+    verified (see max_bucket), so a pair of similarity 'threshold' is found with probability min_recall without
+    comparing all the pairs. Returns the arrays (a, b, similarity) with a < b.
+    """
+    n_decks, n_perm = signatures.shape
+    bands, rows = lsh_params(n_perm, threshold)
+    multipliers = np.random.default_rng(0).integers(0, 2**63, rows, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    candidates = []
+    with span("similarity.lsh"):
+        for band in range(bands):
+            keys = _mix(signatures[:, band * rows:(band + 1) * rows].astype(np.uint64) @ multipliers)
+            candidates.append(_bucket_pairs(keys, n_decks))
+        candidates = np.unique(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
+    count("similarity_candidates", len(candidates))
+    a, b = np.divmod(candidates, n_decks)
+    with span("similarity.verify"):
+        similarity = np.empty(len(a))
+        step = max(1, chunk_size * 8 // n_perm)
+        for start in range(0, len(a), step):
+            chunk = slice(start, start + step)
+            similarity[chunk] = (signatures[a[chunk]] == signatures[b[chunk]]).mean(axis=1)
+    keep = similarity >= threshold
+    a, b = np.minimum(a[keep], b[keep]), np.maximum(a[keep], b[keep])
+    return a, b, similarity[keep]
+
+
+def _components(n_decks, a, b):
+    """Connected components of the decklists linked by the pairs (a, b), as labels numbered by decreasing size
+    (then by first decklist)"""
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    _, labels = connected_components(coo_matrix((np.ones(len(a)), (a, b)), shape=(n_decks, n_decks)), directed=False)
+    sizes = np.bincount(labels)
+    firsts = np.full(len(sizes), n_decks)
+    np.minimum.at(firsts, labels, np.arange(n_decks))
+    ranks = np.empty(len(sizes), dtype=np.int64)
+    ranks[np.lexsort((firsts, -sizes))] = np.arange(len(sizes))
+    return ranks[labels]
+
+
+@timed
+def cluster_decklists(signatures, threshold=0.6):
+    """Cluster the decklists into variants: the clusters are the connected components of the pairs of decklists
+    with a similarity of at least 'threshold' (single linkage). Returns the cluster of each decklist, clusters
+    being numbered by decreasing size."""
+    a, b, _ = similar_pairs(signatures, threshold)
+    labels = _components(len(signatures), a, b)
+    count("clusters", int(labels.max()) + 1 if len(labels) else 0)
+    return labels
+
+
+@timed
+def find_duplicates(signatures, threshold=0.9):
+    """Near-duplicate decklists, e.g. lists copied card for card: for each decklist, the index of the first
+    decklist of its group of decklists with a similarity of at least 'threshold', or -1 for the first one"""
+    a, b, _ = similar_pairs(signatures, threshold)
+    labels = _components(len(signatures), a, b)
+    firsts = np.full(labels.max() + 1 if len(labels) else 0, len(labels))
+    np.minimum.at(firsts, labels, np.arange(len(labels)))
+    duplicate_of = firsts[labels]
+    duplicate_of[duplicate_of == np.arange(len(labels))] = -1
+    count("duplicates", int((duplicate_of >= 0).sum()))
+    return duplicate_of
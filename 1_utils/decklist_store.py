@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import shutil
+from array import array
+import numpy as np
+from instrumentation import count, timed
+
+
+# Columnar store of the decklists of a deck archetype, saved in a 'store' folder next to the txt files:
+#   deck_offsets.npy  int64 (n_decks + 1,)  rows of decklist i are deck_offsets[i]:deck_offsets[i+1]
+#   card_ids.npy      int32 (n_rows,)       index of the card name in 'names'
+#   qty.npy           int16 (n_rows,)       number of copies
+#   sb.npy            int8  (n_rows,)       0 for main deck, 1 for sideboard
+#   store.json        {"names": [...], "decks": [...]} card names and source txt file of each decklist
+store_dir = "store"
+arrays = {"deck_offsets": np.int64, "card_ids": np.int32, "qty": np.int16, "sb": np.int8}
+line_break = re.compile(r"\r\n|\r|\n")
+card_line = re.compile(r"(\d+) (.+)")
+
+
+def iter_decklist_records(decklists):
+    """Stream the (#dl, sb, qty, name) records of decklists given as txt strings, bytes or iterables of lines
+
+    Decklists are parsed in a single pass over their lines: the first blank line after the main deck cards
+    starts the sideboard. Missing lines (e.g. NaN padding of a wide DataFrame column) count as blank lines.
+    Lines that are not '<qty> <name>' (e.g. a 'Sideboard' header) are skipped and counted as 'lines_skipped'.
+    """
+    for dl, decklist in enumerate(decklists):
+        if isinstance(decklist, bytes):
+            decklist = decklist.decode()
+        lines = line_break.split(decklist) if isinstance(decklist, str) else decklist
+        sb = 0
+        in_main = False
+        for line in lines:
+            line = line.strip() if isinstance(line, str) else ""
+            if not line:
+                if in_main:
+                    sb = 1
+                continue
+            match = card_line.fullmatch(line)
+            if match is None:
+                count("lines_skipped")
+                continue
+            in_main = True
+            yield dl, sb, int(match[1]), match[2]
+
+
+@timed
+def parse_decklists(decklists):
+    """Parse decklists into the columns '#dl', 'sb', 'qty' and 'name' of the long format, as numpy arrays
+
+    Integer columns are accumulated in compact typed buffers while streaming the records, so each column is
+    allocated once and the input never needs to be held in a wide or split form.
+    """
+    dl, sb, qty, names = array("q"), array("b"), array("h"), []
+    for dl_, sb_, qty_, name in iter_decklist_records(decklists):
+        dl.append(dl_)
+        sb.append(sb_)
+        qty.append(qty_)
+        names.append(name)
+    count("decks_parsed", dl[-1] + 1 if dl else 0)
+    count("rows_parsed", len(names))
+    name = np.empty(len(names), dtype=object)
+    name[:] = names
+    return {
+        "#dl": np.frombuffer(dl, dtype=np.int64),
+        "sb": np.frombuffer(sb, dtype=np.int8),
+        "qty": np.frombuffer(qty, dtype=np.int16),
+        "name": name,
+    }
+
+
+@timed
+def load_store(path, mmap=True):
+    """Load the columnar store of a decklists folder, memory-mapping the arrays by default
+
+    Returns a dict with the arrays, the card 'names' and the 'decks' file names, or None if the folder has
+    no store yet.
+    """
+    full_path = os.path.join(path, store_dir)
+    if not os.path.exists(os.path.join(full_path, "store.json")):
+        return None
+    with open(os.path.join(full_path, "store.json"), "r") as f:
+        store = json.load(f)
+    mmap_mode = "r" if mmap else None
+    for name in arrays:
+        store[name] = np.load(os.path.join(full_path, f"{name}.npy"), mmap_mode=mmap_mode)
+    # Arrays can be longer than store.json if a write was interrupted, only keep the decks it lists
+    n_rows = store["deck_offsets"][len(store["decks"])]
+    store["deck_offsets"] = store["deck_offsets"][:len(store["decks"]) + 1]
+    for name in ["card_ids", "qty", "sb"]:
+        store[name] = store[name][:n_rows]
+    return store
+
+
+def _stored_decks(path):
+    """Source txt file of each decklist of the store, without loading its arrays"""
+    store_json_path = os.path.join(path, store_dir, "store.json")
+    if not os.path.exists(store_json_path):
+        return []
+    with open(store_json_path, "r") as f:
+        return json.load(f)["decks"]
+
+
+def _save_store(path, store):
+    """Save the store arrays first and store.json last, replacing each file atomically"""
+    full_path = os.path.join(path, store_dir)
+    os.makedirs(full_path, exist_ok=True)
+    for name, dtype in arrays.items():
+        tmp_path = os.path.join(full_path, f"{name}.tmp.npy")
+        np.save(tmp_path, np.asarray(store[name], dtype=dtype))
+        os.replace(tmp_path, os.path.join(full_path, f"{name}.npy"))
+    tmp_path = os.path.join(full_path, "store.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"names": store["names"], "decks": store["decks"]}, f)
+    os.replace(tmp_path, os.path.join(full_path, "store.json"))
+
+
+@timed
+def append_to_store(path, decklists):
+    """Append decklists, given as (file name, text) pairs, to the store. Decklists already stored are skipped"""
+    store = load_store(path, mmap=False) or {
+        "names": [], "decks": [], "deck_offsets": np.zeros(1, dtype=np.int64),
+        "card_ids": np.empty(0, dtype=np.int32), "qty": np.empty(0, dtype=np.int16), "sb": np.empty(0, dtype=np.int8),
+    }
+    stored = set(store["decks"])
+    new_decklists = []
+    for file_name, text in decklists:
+        if file_name not in stored:
+            stored.add(file_name)
+            new_decklists.append((file_name, text))
+    if not new_decklists:
+        return 0
+    new_decks = [file_name for file_name, _ in new_decklists]
+    records = parse_decklists(text for _, text in new_decklists)
+    # Intern the card names, adding the new ones at the end of 'names'
+    names_index = {name: i for i, name in enumerate(store["names"])}
+    card_ids = [names_index.setdefault(name, len(names_index)) for name in records["name"]]
+    lengths = np.bincount(records["#dl"], minlength=len(new_decks))
+    store["names"] = list(names_index)
+    store["decks"] = store["decks"] + new_decks
+    store["deck_offsets"] = np.concatenate([store["deck_offsets"], store["deck_offsets"][-1] + np.cumsum(lengths)])
+    store["card_ids"] = np.concatenate([store["card_ids"], card_ids])
+    store["qty"] = np.concatenate([store["qty"], records["qty"]])
+    store["sb"] = np.concatenate([store["sb"], records["sb"]])
+    _save_store(path, store)
+    count("decks_stored", len(new_decks))
+    return len(new_decks)
+
+
+@timed
+def import_txt_folder(path, files=None):
+    """Import the txt decklists of a folder into its store, in the order of 'files' (sorted txt files by default)
+
+    Only the files not stored yet are read, so it serves both as one-shot importer and to add new downloads.
+    If the store holds decklists left out of 'files' (e.g. positional 'decklist_NNN.txt' files imported before
+    the downloader recorded the same decklists in a manifest), it is rebuilt from 'files' only, together with
+    the analysis state saved in it, so that no decklist is counted twice.
+    """
+    if files is None:
+        files = sorted(file for file in os.listdir(path) if file.endswith(".txt"))
+    # Only the deck names of store.json are read: no array may stay memory-mapped while the store files are
+    # replaced or deleted, which fails on Windows
+    stored = set(_stored_decks(path))
+    if stored - set(files):
+        shutil.rmtree(os.path.join(path, store_dir))
+        count("stores_rebuilt")
+        stored = set()
+    decklists = []
+    for file in files:
+        if file not in stored:
+            with open(os.path.join(path, file), "r") as f:
+                decklists.append((file, f.read()))
+    return append_to_store(path, decklists)
@@ -0,0 +1,309 @@
+import os
+import re
+import json
+import hashlib
+import time
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, urlsplit
+from instrumentation import count, progress, span, timed
+
+
+base_path = os.path.join("0_data", "decklists")
+base_url = "https://www.tcdecks.net"
+manifest_file = "manifest.jsonl"
+
+# HTTP status codes worth retrying: rate limited or transient server errors
+retry_status_codes = {429, 500, 502, 503, 504}
+# Links to the decklists in the raw html of an archetype page, with the '&' escaped or not, and the event date
+# (dd/mm/yyyy) in the table row of each decklist
+decklist_link = re.compile(rb'href=["\']deck\.php\?id=(\d+)&(?:amp;)?iddeck=(\d+)')
+table_row = re.compile(rb'<tr[\s>]', re.IGNORECASE)
+row_date = re.compile(rb'\b(\d{2})/(\d{2})/(\d{4})\b')
+
+
+class _RateLimiter:
+    """Per-host rate limiter: enforces a minimum interval between requests to the same host"""
+
+    def __init__(self, rate_limit):
+        self.min_interval = 1 / rate_limit if rate_limit else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.min_interval:
+            return
+        host = urlsplit(url).netloc
+        # Reserve the next free slot for this host and sleep outside the lock
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _make_session(max_workers):
+    """Create a keep-alive session whose connection pool can serve every worker thread"""
+    # requests is only imported once something is downloaded, reading manifests does not need it
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _get(session, url, rate_limiter, retries=3, backoff=0.5, timeout=30):
+    """GET an url retrying connection errors and retryable status codes with exponential backoff"""
+    import requests
+    for attempt in range(retries + 1):
+        rate_limiter.wait(url)
+        try:
+            response = session.get(url, timeout=timeout)
+            count("http_requests")
+            if response.status_code not in retry_status_codes:
+                response.raise_for_status()
+                count("bytes_downloaded", len(response.content))
+                return response
+            if attempt == retries:
+                response.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        count("http_retries")
+        time.sleep(backoff * 2 ** attempt)
+
+
+def _fetch_iter(session, urls, rate_limiter, max_workers=8, retries=3, backoff=0.5):
+    """Fetch the urls concurrently and yield (index, response, error) triples as the requests complete
+
+    A url failing after its retries (e.g. a 404 or a persistent 5xx) gives a None response and the exception as
+    error, the other urls are still fetched.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_get, session, url, rate_limiter, retries=retries, backoff=backoff): i
+                   for i, url in enumerate(urls)}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as error:
+                yield futures[future], None, error
+
+
+def _fetch_all(session, urls, rate_limiter, max_workers=8, retries=3, backoff=0.5):
+    """Fetch all the urls concurrently and return the responses in the same order as the urls, raising the
+    error of the first url that failed"""
+    responses = [None] * len(urls)
+    errors = {}
+    for i, response, error in _fetch_iter(session, urls, rate_limiter, max_workers=max_workers, retries=retries, backoff=backoff):
+        responses[i] = response
+        if error is not None:
+            errors[i] = error
+    if errors:
+        raise errors[min(errors)]
+    return responses
+
+
+def parse_archetype_page(content):
+    """Decklists linked from the html of an archetype page as a dict {(id, iddeck): event date}, in page order
+
+    Event dates are ISO 'yyyy-mm-dd' strings taken from the table row of each decklist, or None if the row has
+    no date. The raw bytes of the page are scanned with compiled regexes, no DOM is built.
+    """
+    decks = {}
+    for row in table_row.split(content):
+        links = decklist_link.findall(row)
+        if not links:
+            continue
+        date = row_date.search(row)
+        date = f"{date[3].decode()}-{date[2].decode()}-{date[1].decode()}" if date else None
+        for id_, iddeck in links:
+            decks.setdefault((int(id_), int(iddeck)), date)
+    return decks
+
+
+def read_manifest(path):
+    """Read the manifest of a decklists folder as a dict {(id, iddeck): entry} in download order
+
+    A later entry of the same decklist (e.g. adding its event date) updates the earlier one.
+    Entries whose decklist file is missing are left out, as well as a truncated last line left by an
+    interrupted run, so those decklists are downloaded again.
+    """
+    manifest = {}
+    manifest_path = os.path.join(path, manifest_file)
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if os.path.exists(os.path.join(path, entry["file"])):
+                manifest[(entry["id"], entry["iddeck"])] = entry
+    return manifest
+
+
+def _append_manifest(path, entry):
+    """Append an entry to the manifest, flushing it so that an interrupted run can resume from it"""
+    with open(os.path.join(path, manifest_file), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@timed
+def download_decklists(deck_name, format, n_pages=None, max_workers=8, rate_limit=5, retries=3, backoff=0.5, url=base_url,
+                       stop_at_known=False, flag_duplicates=False, duplicate_threshold=0.9):
+    """Download the decklists of a deck archetype from tcdecks
+
+    Pages of the archetype listing are fetched until the first page without new decklist ids (past the last page
+    the site returns empty pages), or up to 'n_pages' pages if given. With 'stop_at_known', the listing also stops
+    at the first page whose decklists are all downloaded already, which suits frequent updates of a listing sorted
+    by date. Use it only once a full download has completed, as an older interrupted download would leave gaps.
+    Listing pages are fetched by waves of 1, 2, 4... up to 'max_workers' pages, so a run with nothing new only
+    fetches page 1.
+
+    Pages and decklists are fetched concurrently by up to 'max_workers' threads sharing a keep-alive
+    session. 'rate_limit' caps the requests per second sent to each host (None or 0 to disable) and
+    failed requests are retried 'retries' times with exponential backoff starting at 'backoff' seconds.
+    'url' is the root of the site, which allows pointing the downloader to a local stand-in server.
+
+    Decklists are saved as 'decklist_<id>_<iddeck>.txt' and recorded in 'manifest.jsonl' together with
+    their event date, fetch time and content hash. Event dates missing from the entries of older runs are
+    added when the listing gives them. Decklists already in the manifest are not downloaded again, so
+    a re-run only fetches new decklists and an interrupted run resumes where it stopped. Decklists whose request
+    still fails after the retries are reported and left out of the manifest, the others are saved and stored, so
+    the next run only tries the failed ones again.
+
+    With 'flag_duplicates', the decklists with a similarity of at least 'duplicate_threshold' to an earlier
+    decklist (e.g. lists copied card for card) get the file of that decklist as 'duplicate_of' in the manifest,
+    and read_decklists can leave them out. See decklist_similarity.
+    """
+
+    session = _make_session(max_workers)
+    rate_limiter = _RateLimiter(rate_limit)
+
+    ### Download ids of decklists for a given deck archetype, page by page until the listing runs out
+    progress("start", "pages", f"Downloading ids of decklists for deck {deck_name}...")
+    pages_url = f"{url}/archetype.php?format={quote(format)}&archetype={deck_name.lower().replace(' ', '%20')}&page="
+    deck_name = deck_name.lower().replace(" ", "_")
+    format = format.lower().replace(" ", "_")
+    full_path = os.path.join(base_path, format, deck_name)
+    os.makedirs(full_path, exist_ok=True)
+    manifest = read_manifest(full_path)
+
+    decks_dates = {}
+    page = 1
+    done = False
+    # Pages fetched at a time. Unless all the pages up to n_pages are wanted, the listing may end (or be known)
+    # from the first page on, so the waves start with page 1 alone and double up to max_workers pages: the pages
+    # fetched past the end are at most one more than the useful ones, and at most max_workers
+    wave = max_workers if n_pages is not None and not stop_at_known else 1
+    while not done and (n_pages is None or page <= n_pages):
+        last_page = page + wave - 1 if n_pages is None else min(page + wave - 1, n_pages)
+        wave = min(wave * 2, max_workers)
+        urls = [f"{pages_url}{i}" for i in range(page, last_page + 1)]
+        with span("download.fetch_pages"):
+            responses = _fetch_all(session, urls, rate_limiter, max_workers=max_workers, retries=retries, backoff=backoff)
+        count("pages_fetched", len(responses))
+        with span("download.parse_pages"):
+            for response in responses:
+                progress("progress", "pages", f"Fetching page {page}/{n_pages}..." if n_pages else f"Fetching page {page}...",
+                         current=page, total=n_pages)
+                page_decks = {deck_id: date for deck_id, date in parse_archetype_page(response.content).items() if deck_id not in decks_dates}
+                if not page_decks or (stop_at_known and all(deck_id in manifest for deck_id in page_decks)):
+                    done = True
+                    break
+                decks_dates.update(page_decks)
+                page += 1
+    progress("done", "pages")
+
+    ### Skip the decklists already downloaded by a previous run, recording the event dates they were missing
+    for deck_id, date in decks_dates.items():
+        if deck_id in manifest and date and not manifest[deck_id].get("event_date"):
+            _append_manifest(full_path, {**manifest[deck_id], "event_date": date})
+    decks_ids = list(decks_dates)
+    new_decks_ids = [deck_id for deck_id in decks_ids if deck_id not in manifest]
+    progress("info", "manifest", f"{len(decks_ids) - len(new_decks_ids)} decklists already in '{full_path}', {len(new_decks_ids)} new.\n",
+             n_known=len(decks_ids) - len(new_decks_ids), n_new=len(new_decks_ids))
+
+    ### Download new decklists and save each one to its txt file as soon as it arrives. Manifest entries are
+    ### appended in listing order, so the store order does not depend on the order in which the requests complete
+    progress("start", "decklists", "Downloading decklists...")
+    decklists_urls = [f"{url}/download.php?ext=txt&id={id_}&iddeck={iddeck}" for id_, iddeck in new_decks_ids]
+    entries = {}
+    failed = []
+    next_entry = 0
+    with span("download.fetch_decklists"):
+        for n_done, (i, response, error) in enumerate(_fetch_iter(session, decklists_urls, rate_limiter, max_workers=max_workers,
+                                                                  retries=retries, backoff=backoff)):
+            id_, iddeck = new_decks_ids[i]
+            progress("progress", "decklists", f"Fetching {n_done+1}/{len(new_decks_ids)}: id {id_}, iddeck {iddeck}...",
+                     current=n_done+1, total=len(new_decks_ids))
+            if error is not None:
+                # Left out of the manifest, so the next run tries it again
+                failed.append((id_, iddeck))
+                count("decklists_failed")
+                entries[i] = None
+            else:
+                decklist = response.text.replace('\n', '')
+                file_name = f"decklist_{id_}_{iddeck}.txt"
+                with open(os.path.join(full_path, file_name), 'w') as f:
+                    f.write(decklist)
+                entries[i] = {
+                    "id": id_,
+                    "iddeck": iddeck,
+                    "file": file_name,
+                    "event_date": decks_dates[id_, iddeck],
+                    "fetched_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    "sha256": hashlib.sha256(decklist.encode()).hexdigest(),
+                }
+                count("decklists_downloaded")
+            while next_entry in entries:
+                entry = entries.pop(next_entry)
+                if entry is not None:
+                    _append_manifest(full_path, entry)
+                next_entry += 1
+    session.close()
+    progress("done", "decklists")
+    if failed:
+        progress("info", "decklists", f"{len(failed)} decklists failed and will be tried again by the next run: "
+                 f"{', '.join(f'id {id_}, iddeck {iddeck}' for id_, iddeck in failed)}.\n", failed=failed)
+
+    ### Append the new decklists (and any left out by an interrupted run) to the columnar store
+    from decklist_store import import_txt_folder
+    manifest = read_manifest(full_path)
+    n_stored = import_txt_folder(full_path, files=[entry["file"] for entry in manifest.values()])
+    progress("info", "store", f"{n_stored} decklists added to the store of '{full_path}'.\n", n_stored=n_stored)
+
+    if flag_duplicates:
+        n_duplicates = _flag_duplicates(full_path, manifest, duplicate_threshold)
+        progress("info", "duplicates", f"{n_duplicates} near-duplicate decklists flagged in '{full_path}'.\n",
+                 n_duplicates=n_duplicates)
+
+
+@timed
+def _flag_duplicates(path, manifest, threshold):
+    """Record in the manifest the near-duplicate of each decklist of the store, returning the number of duplicates
+
+    Only the entries whose flag changes are appended, so a re-run with the same threshold appends nothing.
+    """
+    from decklist_store import load_store
+    from decklist_similarity import find_duplicates, minhash_signatures
+    store = load_store(path)
+    if store is None:
+        return 0
+    duplicate_of = find_duplicates(minhash_signatures(store["deck_offsets"], store["card_ids"], store["qty"], store["sb"],
+                                                      store["names"]), threshold)
+    entries = {entry["file"]: entry for entry in manifest.values()}
+    n_duplicates = 0
+    for file, i in zip(store["decks"], duplicate_of):
+        duplicate = store["decks"][i] if i >= 0 else None
+        n_duplicates += duplicate is not None
+        if file in entries and entries[file].get("duplicate_of") != duplicate:
+            _append_manifest(path, {**entries[file], "duplicate_of": duplicate})
+    return n_duplicates
@@ -1,218 +1,127 @@
 import os
+import pickle
 import pandas as pd
 import numpy as np
-import json
-import requests
-from bs4 import BeautifulSoup
-import re
-import pdb
-
+import heapq
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from downloader import download_decklists, read_manifest
+from decklist_store import import_txt_folder, load_store, parse_decklists, store_dir
+from cards_db import add_missing_cards, cards_version, load_cards_db, lookup_cards
+from decklist_similarity import cluster_decklists, minhash_signatures
+from instrumentation import count, progress, span, timed
+from result_cache import cached
+
+# Public API of the pipeline, download_decklists being re-exported for the notebooks ('fun.download_decklists')
+__all__ = [
+    "download_decklists", "read_decklists", "process_decklists", "build_card_matrices", "allocate_final_qty",
+    "card_histograms", "card_histogram_stats", "partition_state", "merge_states", "analyze_dls", "analyze_state",
+    "load_analysis_state", "update_analysis", "build_trend_index", "trend_analysis", "rolling_trends",
+    "card_cooccurrence", "bootstrap_analysis", "cluster_partitions", "analyze_batch",
+]
 
 base_path = os.path.join("0_data", "decklists")
+# Aggregate states of the color partitions of an archetype, saved in its store by update_analysis
+analysis_state_file = "analysis_state.pkl"
+# First decklist of the qtys played by no decklist in the states of partition_state
+_no_deck = np.iinfo(np.int64).max // 2
+
+
+@timed
+def read_decklists(deck_name, format, skip_duplicates=False):
+    """Read the decklists of a deck archetype as a long format DataFrame with columns '#dl', 'sb', 'qty' and 'name'
+
+    Decklists are loaded from the memory-mapped columnar store of the folder. Txt files not yet in the store
+    (e.g. folders downloaded before the store existed) are imported into it first. With 'skip_duplicates', the
+    decklists flagged as near-duplicates in the manifest (see download_decklists) are left out.
+    """
+    path, store = _open_store(deck_name, format)
+    df = _store_frame(store)
+    if skip_duplicates:
+        duplicates = {entry["file"] for entry in read_manifest(path).values() if entry.get("duplicate_of")}
+        keep = np.array([deck not in duplicates for deck in store["decks"]], dtype=bool)
+        count("duplicates_skipped", int((~keep).sum()))
+        df = df[keep[df["#dl"].to_numpy()]].reset_index(drop=True)
+    return df
 
 
-def download_decklists(deck_name, format, n_pages):
-    
-    ### Download ids of decklists for a given deck archetype and the number of pages
-    print(f"Downloading ids of decklists for deck {deck_name}...")
-    deck_name = deck_name.lower().replace(" ", "%20")
-    format = format.lower().replace(" ", "_")
-    base_url = f"https://www.tcdecks.net/archetype.php?format=Premodern&archetype={deck_name}&page="
-    decks_ids = []
-    for page in range(1, n_pages+1):
-        print(f"\r\tFetching page {page}/{n_pages}...", end="")
-        url = f"{base_url}{page}"
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        pattern = re.compile(r'deck\.php\?id=(\d+)&iddeck=(\d+)')
-        page_decks_ids = [(int(id_), int(iddeck)) for id_, iddeck in (pattern.match(a['href']).groups() for a in soup.find_all('a', href=True) if pattern.match(a['href']))]
-        page_decks_ids = list(set(page_decks_ids))
-        decks_ids.extend(page_decks_ids)
-    print("\r\tDone!\n")
-    
-    ### Download decklists for each deck id
-    print(f"Downloading decklists...")
-    decklists = []
-    for i, (id_, iddeck) in enumerate(decks_ids):
-        print(f"\r\tFetching {i+1}/{len(decks_ids)}: id {id_}, iddeck {iddeck}...", end="")
-        url = f"https://www.tcdecks.net/download.php?ext=txt&id={id_}&iddeck={iddeck}"
-        r = requests.get(url)
-        decklists.append(r.text)
-    print("\r\tDone!\n")
-
-    ### Save decklists to txt files
-    deck_name = deck_name.replace("%20", "_")
-    full_path = os.path.join(base_path, format, deck_name.replace("%20", " "))
-    os.makedirs(full_path, exist_ok=True)
-    print(f"Saving decklists to '{full_path}'...")
-    digits_len = len(str(len(decks_ids)))
-    for i, decklist in enumerate(decklists):
-        i_str = str(i).zfill(digits_len)
-        print(f"\r\tSaving decklist {i+1}/{len(decks_ids)}...", end="")
-        final_path = os.path.join(full_path, f'decklist_{i_str}.txt')
-        with open(final_path, 'w') as f:
-            f.write(decklist.replace('\n', ''))
-    print("\r\tDone!\n")
-
-
-
-def read_decklists(deck_name, format):
+def _open_store(deck_name, format):
+    """Import the new txt decklists of an archetype into its store and return the folder path and the store"""
     format = format.lower().replace(" ", "_")
     deck_name = deck_name.lower().replace(" ", "_")
     path = os.path.join(base_path, format, deck_name)
-    df = pd.DataFrame()
-    files = os.listdir(path)
-    files.sort()
-    for file in files:
-        # Check whether file is in text format or not
-        if file.endswith(".txt"):
-            file_path = os.path.join(path, file)
-            df = pd.concat([df, pd.read_csv(file_path, header=None, skip_blank_lines=False, sep="*")], axis=1)
-    df.columns = list(range(len(df.columns)))
+    # Import the decklists recorded in the manifest if there is one, otherwise all the txt files
+    manifest = read_manifest(path)
+    import_txt_folder(path, files=[entry["file"] for entry in manifest.values()] if manifest else None)
+    return path, load_store(path)
+
+
+def _store_frame(store, start=0):
+    """Long format DataFrame of the decklists of a store from position 'start' on"""
+    # Number of cards of each decklist, to give every row the position of its decklist
+    lengths = np.diff(store["deck_offsets"][start:])
+    rows = slice(store["deck_offsets"][start], store["deck_offsets"][-1])
+    df = pd.DataFrame({
+        "#dl": np.repeat(np.arange(start, start + len(lengths)), lengths),
+        "sb": store["sb"][rows].astype(int),
+        "qty": store["qty"][rows].astype(int),
+        "name": np.asarray(store["names"], dtype=object)[store["card_ids"][rows]],
+    })
+    count("rows_materialised", len(df))
     return df
 
 
 
-def process_decklists(df, format):
-    
+def _process_key(df, format):
     format = format.lower().replace(" ", "_")
+    return [df, format, cards_version(format)]
 
-    def _read_cards_db(name_values:pd.Series,
-                       cards_db_excel_path=os.path.join("0_data", "cards_database.xlsx"),
-                       cards_db_json_path=os.path.join("0_data", "cards_database.json")):
-
-        def _read_n_update_cards_db(name_values:pd.Series,
-                                    cards_db_json_path=os.path.join("0_data", "cards_database.json")):
-            # Load cards_database dict
-            try:
-                with open(cards_db_json_path, "r") as file:
-                    cards_database = json.load(file)
-            except:
-                cards_database = {format: {}}
-            # Get card names
-            unique_name_values = name_values.unique()
-            # Add missing cards to cards_database
-            for name in unique_name_values:
-                if name not in cards_database[format]:
-                    cards_database[format][name] = {"type": "unknown", "subtype": "unknown", "color": "unknown"}
-            # Save cards_database dict
-            with open(cards_db_json_path, "w") as file:
-                json.dump(cards_database, file)
-            return cards_database
-
-        cards_db_excel = pd.read_excel(cards_db_excel_path)
-        cards_database = _read_n_update_cards_db(name_values, cards_db_json_path)
-        for row in cards_db_excel.iterrows():
-            row_list = row[1].values
-            if row_list[0] not in cards_database:
-                cards_database[row_list[0]] = {}
-            if row_list[1] not in cards_database[row_list[0]]:
-                cards_database[row_list[0]][row_list[1]] = {}
-                cards_database[row_list[0]][row_list[1]]["type"] = row_list[2]
-                cards_database[row_list[0]][row_list[1]]["subtype"] = row_list[3]
-                cards_database[row_list[0]][row_list[1]]["color"] = row_list[4]
-        # Save cards_database dict
-        with open(cards_db_json_path, "w") as file:
-            json.dump(cards_database, file)
-        return cards_database
-    
 
-    def _create_deck_colors_column(df):
-        """Create a column with the colors of the deck"""
-
-        def _join_colors(group):
-            """"Define a function that joins all the 'color' strings in a group, removes 'C', and sorts the characters"""
-            colors = ''.join(group['color'].fillna('').astype(str))
-            # Remove 'C'
-            colors = colors.replace('C', '')
-            # Sort in the order 'WUBRG' and remove duplicates
-            colors = ''.join(sorted(set(c for c in colors if c in "WUBRG"), key="WUBRG".index))
-            return colors
-
-        # Filter the DataFrame to only include rows where 'qty' > 0
-        df_filtered = df[(df['qty'] > 0) & (df['type'] != "Land")]
-        # Create a DataFrame with the colors of each deck
-        deck_colors = df_filtered.groupby('#dl').apply(_join_colors).reset_index()
-        deck_colors.columns = ['#dl', 'deck_colors']
-        # Merge df with deck_colors
-        df = df.merge(deck_colors, on='#dl', how='left')
-        # Reorder the characters in 'deck_colors' to be in the order 'WUBRG'
-        df['deck_colors'] = df['deck_colors'].apply(lambda x: ''.join(sorted(x, key="WUBRG".index)))
-        # Reset the index
-        df.reset_index(inplace=True, drop=True)
-
-        return df["deck_colors"]
-
-    def _fill_all_possible_cards(df):
-        #### Fill missing cards to have all the possible cards in every decklist
-        # Separate main and sideboard
-        df_main = df[df['sb'] == 0]
-        df_sideboard = df[df['sb'] == 1]
-        # Get unique values
-        dl_values = df['#dl'].unique()
-        name_values_main = df_main['name'].unique()
-        name_values_sideboard = df_sideboard['name'].unique()
-        # Create full index
-        index_main = pd.MultiIndex.from_product([dl_values, name_values_main], names=['#dl', 'name'])
-        index_sideboard = pd.MultiIndex.from_product([dl_values, name_values_sideboard], names=['#dl', 'name'])
-        # Create full dataframes
-        df_full_main = pd.DataFrame(index=index_main).reset_index()
-        df_full_main['sb'] = 0
-        df_full_sideboard = pd.DataFrame(index=index_sideboard).reset_index()
-        df_full_sideboard['sb'] = 1
-        # Merge with original dataframes
-        df_main = pd.merge(df_full_main, df_main, on=['#dl', 'name', 'sb'], how='left')
-        df_sideboard = pd.merge(df_full_sideboard, df_sideboard, on=['#dl', 'name', 'sb'], how='left')
-        # Fill NaNs with 0
-        df_main['qty'] = df_main['qty'].fillna(0).astype(int)
-        df_sideboard['qty'] = df_sideboard['qty'].fillna(0).astype(int)
-        # Concatenate main and sideboard
-        df = pd.concat([df_main, df_sideboard])
-        return df
-
-
-    # Change df to long format and add columns for sb, qty and name
-    df = pd.melt(df, var_name= "#dl", value_name="cards")
-    df["sb"] = 0
-    df[["qty", "name"]] = df["cards"].str.strip().str.split(" ", n=1, expand=True)
-    df = df.drop("cards", axis=1)
-
-    # Separation of main and sb using NaNs
-    for decklist_no in df["#dl"].unique():
-        index_start = df.loc[df["#dl"]==decklist_no].iloc[0].name
-        index_sb = df.loc[(df["#dl"]==decklist_no) & (df["qty"].isna()), "name"].index[0]
-        index_end = index_start + df.loc[df["#dl"]==decklist_no].shape[0]
-        df.iloc[index_sb:index_end, 1] = 1
-    # Dropa NaNs after separation of main and sb
-    df = df.dropna(ignore_index=True)
-
-    # Change qty to integer
-    df["qty"] = df["qty"].astype(int)
-    
-    # Read, update and populate cards database
-    cards_database = _read_cards_db(name_values=df["name"],
-                                    cards_db_excel_path=os.path.join("0_data", "cards_database.xlsx"),
-                                    cards_db_json_path=os.path.join("0_data", "cards_database.json"))
+@timed
+@cached(_process_key)
+def process_decklists(df, format):
     
-    # Create column type with the types of the cards
-    df["type"] = df["name"].map(cards_database[format]).str["type"]
-    # Create column color with the colors of the cards
-    df["color"] = df["name"].map(cards_database[format]).str["color"]
-    # Create a column with the colors of the deck
-    df["deck_colors"] = _create_deck_colors_column(df)
+    format = format.lower().replace(" ", "_")
+
+    def _create_deck_colors_masks(df):
+        """Create an array with the colors of the deck of each row, as 5-bit WUBRG masks"""
+        # Encode each distinct color string of the cards once, e.g. "WU" -> 0b00011. 'C' and missing colors are 0
+        color_codes, color_values = pd.factorize(df["color"])
+        color_masks = np.array([sum(1 << i for i, c in enumerate("WUBRG") if c in str(color)) for color in color_values] + [0])
+        masks = color_masks[color_codes]
+        # Only non land cards with qty > 0 count for the colors of the deck
+        masks[~((df["qty"] > 0) & (df["type"] != "Land")).to_numpy()] = 0
+        # Colors of each deck as the bitwise OR of the masks of its rows, over the rows grouped by deck
+        dl_codes, dl_values = pd.factorize(df["#dl"])
+        order = np.argsort(dl_codes, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(dl_codes[order]) != 0])
+        deck_masks = np.bitwise_or.reduceat(masks[order], starts) if len(order) else np.zeros(0, dtype=int)
+        return deck_masks[dl_codes]
+
+
+    # Decklists given as one column of txt lines per decklist (wide format) are parsed to long format
+    if "name" not in df.columns:
+        df = pd.DataFrame(parse_decklists(df[column] for column in df.columns))
+        df["sb"] = df["sb"].astype(int)
+        df["qty"] = df["qty"].astype(int)
+    else:
+        # Work on a copy, the frame of the caller is left unchanged (and hashes to the same cache key again)
+        df = df[["#dl", "sb", "qty", "name"]].copy()
+
+    # Add the new cards to the cards database
+    add_missing_cards(format, df["name"])
+    # Create columns type, subtype and color with a single lookup of the cards in the database
+    df["type"], df["subtype"], df["color"] = lookup_cards(format, df["name"])
+    # Create a column with the colors of the deck, converting each of the 32 possible masks to its "WUBRG" label
+    deck_masks = _create_deck_colors_masks(df)
+    colors_labels = np.array(["".join(c for i, c in enumerate("WUBRG") if mask >> i & 1) for mask in range(32)], dtype=object)
+    df["deck_colors"] = colors_labels[deck_masks]
 
     dfs = []
-    for deck_color in df["deck_colors"].unique():
-        # Filter by deck color
-        df_color = df[df["deck_colors"]==deck_color]
-        # Fill missing cards to have all the possible cards in every decklist
-        df_color = _fill_all_possible_cards(df_color)
-        # Repopulate 'deck_colors', 'color' and 'type' columns after filling missing cards
-        df_color["deck_colors"] = deck_color
-        df_color["color"] = df_color["name"].map(cards_database[format]).str["color"]
-        df_color["type"] = df_color["name"].map(cards_database[format]).str["type"]
-        # Create column subtype
-        df_color["subtype"] = df_color["name"].map(cards_database[format]).str["subtype"]  
+    for deck_mask in pd.unique(deck_masks):
+        # Filter by deck color. Cards missing from a decklist are not filled with 0 qty rows, the sparse
+        # matrices built by analyze_dls account for them
+        df_color = df[deck_masks==deck_mask]
         # Reorder columns
         df_color = df_color[["#dl", "deck_colors", "sb", "type", "subtype", "color", "qty", "name"]]
         # Sort by decklist number and sb
@@ -221,123 +130,341 @@ def process_decklists(df, format):
         df_color = df_color.reset_index(drop=True)
         # Append to list
         dfs.append(df_color)
+    count("partitions", len(dfs))
+    count("rows_materialised", len(df))
 
     return dfs
 
 
+@timed
+def build_card_matrices(df):
+    """Build the sparse decklist x card quantity matrices of a color partition, one for main and one for sideboard
+
+    Card names are interned to integer ids, the columns of the matrices. Returns a dict with the '#dl' of the
+    matrix rows under 'decks' and, for each sb value, a tuple (matrix, cards) where matrix is a CSR matrix of
+    shape (n_decks, n_cards) and cards a DataFrame with the 'name', 'type', 'subtype' and 'color' of each column.
+    """
+    # scipy is only imported once decklists are analyzed, reading and processing them does not need it
+    from scipy.sparse import csr_matrix
+    decks, rows = np.unique(df["#dl"].to_numpy(), return_inverse=True)
+    matrices = {"decks": decks}
+    for sb in [0, 1]:
+        mask = (df["sb"] == sb).to_numpy()
+        df_sb = df[mask]
+        card_ids, names = pd.factorize(df_sb["name"], sort=True)
+        cards = (
+            df_sb.drop_duplicates("name")
+            .set_index("name")
+            .reindex(pd.Index(names, name="name"))[["type", "subtype", "color"]]
+            .reset_index()
+        )
+        matrix = csr_matrix((df_sb["qty"].to_numpy(), (rows[mask], card_ids)), shape=(len(decks), len(names)))
+        matrix.sum_duplicates()
+        matrices[sb] = (matrix, cards)
+    return matrices
+
+
+@timed
+def allocate_final_qty(final_qty, target, preferred, priority, mean, lower=0, upper=np.inf, label=""):
+    """Adjust the final quantities of a group of cards (or types) so that they add up exactly to 'target'
+
+    First, cards are moved to their 'preferred' qty (e.g. mode_2nd) by increasing 'priority', when the move
+    brings the total closer to the target without overshooting it, or when 'preferred' is closer to 'mean' than
+    the current qty, whichever the direction of the gap. The remaining gap is closed one copy at a time, always
+    stepping the card whose step least increases the squared distance of final_qty to 'mean' (a priority queue
+    of marginal costs). With the rounded mean as 'preferred' (types), this gives the allocation closest to the
+    means, e.g. the rounded means themselves when they add up to the target. At the rounded mean this follows the 'diff' ordering, and ties go to the
+    lowest 'priority'. Quantities are kept within 'lower' and 'upper', and if the target cannot be reached
+    within those bounds a warning is issued and the closest allocation is returned.
+
+    Runs in O(n log n + gap log n) for n cards.
+    """
+    dtype = np.asarray(final_qty).dtype
+    qty = np.asarray(final_qty, dtype=float).copy()
+    preferred = np.asarray(preferred, dtype=float)
+    mean = np.asarray(mean, dtype=float)
+    lower = np.broadcast_to(np.asarray(lower, dtype=float), qty.shape)
+    upper = np.broadcast_to(np.asarray(upper, dtype=float), qty.shape)
+    qty = np.clip(qty, lower, upper)
+    rank = np.empty(len(qty), dtype=int)
+    rank[np.argsort(np.asarray(priority), kind="stable")] = np.arange(len(qty))
+    gap = target - qty.sum()
+
+    # Moves to the preferred qty, by priority
+    n_moves = 0
+    for i in np.argsort(rank):
+        delta = preferred[i] - qty[i]
+        if delta == 0 or not lower[i] <= preferred[i] <= upper[i]:
+            continue
+        if (delta * gap > 0 and abs(delta) <= abs(gap)) or abs(preferred[i] - mean[i]) < abs(qty[i] - mean[i]):
+            qty[i] += delta
+            gap -= delta
+            n_moves += 1
+
+    # Unit steps by marginal cost: stepping q by s costs (q + s - mean)^2 - (q - mean)^2 = 1 + 2 s (q - mean)
+    step = np.sign(gap)
+    bound = upper if step > 0 else lower
+    heap = [(1 + 2 * step * (qty[i] - mean[i]), rank[i], i) for i in range(len(qty)) if qty[i] != bound[i]]
+    heapq.heapify(heap)
+    n_moves += abs(gap)
+    while gap != 0 and heap:
+        cost, rank_i, i = heapq.heappop(heap)
+        qty[i] += step
+        gap -= step
+        if qty[i] != bound[i]:
+            heapq.heappush(heap, (cost + 2, rank_i, i))
+
+    count("allocation_steps", int(n_moves - abs(gap)))
+    if gap != 0:
+        warnings.warn(f"final_qty of {label or 'group'} cannot reach {target} within the qty bounds, "
+                      f"total is {target - gap:.0f}")
+    return qty.astype(dtype) if np.issubdtype(dtype, np.integer) else qty
+
+
+@timed
+def card_histograms(matrix):
+    """Histogram of the qty of each card over the decklists of a decklist x card quantity matrix
+
+    Returns 'hist', an array of shape (n_cards, max_qty + 1) with the number of decklists playing each qty of
+    each card (column 0 counting the decklists without the card), and 'first', an array of the same shape
+    with the first decklist (matrix row) playing each qty of each card, or n_decks if none does.
+    """
+    n_decks, n_cards = matrix.shape
+    coo = matrix.tocoo()
+    n_qty = int(coo.data.max()) + 1 if coo.nnz else 1
+    bins = coo.col.astype(np.int64) * n_qty + coo.data.astype(np.int64)
+    hist = np.bincount(bins, minlength=n_cards * n_qty).reshape(n_cards, n_qty)
+    hist[:, 0] = n_decks - hist[:, 1:].sum(axis=1)
+    first = np.full(n_cards * n_qty, n_decks)
+    np.minimum.at(first, bins, coo.row)
+    first = first.reshape(n_cards, n_qty)
+    # Rows of a sorted csc column are increasing, so the first decklist without the card is the number of
+    # leading rows 0, 1, 2... of the column
+    csc = matrix.tocsc()
+    csc.sort_indices()
+    csc_cols = np.repeat(np.arange(n_cards), np.diff(csc.indptr))
+    first_zero = np.bincount(csc_cols[csc.indices == np.arange(csc.nnz) - csc.indptr[csc_cols]], minlength=n_cards)
+    first[:, 0] = np.where(hist[:, 0] > 0, first_zero, n_decks)
+    return hist, first
+
+
+@timed
+def card_histogram_stats(hist, first):
+    """Compute the statistics of the qty of each card from its histogram in a single vectorized pass
+
+    'hist' and 'first' are the arrays returned by card_histograms. Returns a dict of columns with the
+    count, sum, rounded mean, mean, std, the 5 most frequent qtys (ties going to the qty played first) with
+    their share of decklists, min, max and share of decklists playing the card.
+    """
+    n_cards, n_qty = hist.shape
+    n_decks = hist[0].sum() if n_cards else 0
+    qty = np.arange(n_qty)
+    sums = hist @ qty
+    sums_sq = hist @ qty ** 2
+    mean = sums / n_decks
+    std = np.sqrt(np.maximum(sums_sq - sums * mean, 0) / (n_decks - 1)) if n_decks > 1 else np.full(n_cards, np.nan)
+    present = hist > 0
+
+    # Rank qtys by decreasing count and then by first decklist, qtys with no decklist last
+    scale = int(first[present].max(initial=0)) + 1
+    order = np.argsort(np.where(present, -hist * scale + first, np.iinfo(np.int64).max), axis=1, kind="stable")
+    if n_qty < 5:
+        order = np.pad(order, ((0, 0), (0, 5 - n_qty)))
+    order = order[:, :5]
+    ranked_hist = np.take_along_axis(hist, order, axis=1)
+    ranked_hist[:, n_qty:] = 0
+
+    stats = {
+        "n_dls": n_decks,
+        "sum": sums,
+        "mean_rnd": mean.round(0).astype(int),
+        "mean": mean,
+        "std": std,
+    }
+    for i, mode in enumerate(["mode_1st", "mode_2nd", "mode_3rd", "mode_4th", "mode_5th"]):
+        has_mode = ranked_hist[:, i] > 0
+        stats[mode] = order[:, i] if has_mode.all() else np.where(has_mode, order[:, i], np.nan)
+        stats[f"%_{mode}"] = ranked_hist[:, i] / n_decks
+    stats["min"] = present.argmax(axis=1)
+    stats["max"] = n_qty - 1 - present[:, ::-1].argmax(axis=1)
+    stats["%_dls_w_card"] = 1 - hist[:, 0] / n_decks
+    return stats
+
+
+@timed
+def partition_state(df):
+    """Mergeable aggregate state of the decklists of a color partition
+
+    For each sb, the state holds the attributes of the cards, their qty histograms with the first decklist
+    playing each qty (see card_histograms) and, for each type, the histogram of the total qty of the type per
+    decklist. analyze_state computes df_types and df_cards from it, and merge_states adds the decklists of
+    another state, so new decklists are folded in without reading the old ones again. Decklists are taken by
+    increasing '#dl'.
+    """
+    matrices = build_card_matrices(df)
+    state = {"deck_colors": df["deck_colors"].iloc[0], "n_decks": len(matrices["decks"])}
+    for sb in [0, 1]:
+        matrix, cards = matrices[sb]
+        hist, first = card_histograms(matrix)
+        first[hist == 0] = _no_deck
+        types, totals = _types_totals(matrix, cards)
+        state[sb] = {"cards": cards, "hist": hist, "first": first, "types": types, "types_hist": _columns_histogram(totals)}
+    return state
+
+
+def _types_totals(matrix, cards):
+    """Sorted types of the cards (columns) of a decklist x card matrix and the total qty of each type in each
+    decklist, as a dense decklists x types array"""
+    from scipy.sparse import csr_matrix
+    valid = cards["type"].notna().to_numpy()
+    types, types_ids = np.unique(cards.loc[valid, "type"].to_numpy(dtype=object), return_inverse=True)
+    types_matrix = csr_matrix((np.ones(len(types_ids), dtype=np.int64), (np.flatnonzero(valid), types_ids)), shape=(len(cards), len(types)))
+    return types, (matrix @ types_matrix).toarray()
+
+
+def _columns_histogram(values):
+    """Histogram of each column of a non negative integer array, as an array of shape (n_columns, max + 1)"""
+    n_columns = values.shape[1]
+    width = int(values.max()) + 1 if values.size else 1
+    bins = np.arange(n_columns) * width + values.astype(np.int64)
+    return np.bincount(bins.ravel(), minlength=n_columns * width).reshape(n_columns, width)
+
+
+def _merge_histograms(keys, parts):
+    """Sum histograms over the union of their rows, given as (row keys, hist, n_decks) parts
+
+    Rows missing from a part count all its decklists in bin 0. Returns the merged histogram, with one row per
+    key of the pd.Index 'keys', and the positions of the rows of each part in it.
+    """
+    width = max(hist.shape[1] for _, hist, _ in parts)
+    merged = np.zeros((len(keys), width), dtype=np.int64)
+    positions = []
+    for part_keys, hist, n_decks in parts:
+        pos = keys.get_indexer(part_keys)
+        merged[:, 0] += n_decks
+        merged[pos, 0] -= n_decks
+        merged[pos, :hist.shape[1]] += hist
+        positions.append(pos)
+    return merged, positions
+
+
+@timed
+def merge_states(state, other):
+    """Merge two states of partition_state, the decklists of 'other' coming after those of 'state'
+
+    Card attributes are taken from 'state' for the cards in both, so a state stays consistent with the cards
+    database it was first folded with. Runs in O(cards), whatever the number of decklists.
+    """
+    n_decks = state["n_decks"]
+    merged = {"deck_colors": state["deck_colors"], "n_decks": n_decks + other["n_decks"]}
+    for sb in [0, 1]:
+        a, b = state[sb], other[sb]
+        cards = (
+            pd.concat([a["cards"], b["cards"]])
+            .drop_duplicates("name")
+            .sort_values("name")
+            .reset_index(drop=True)
+        )
+        names = pd.Index(cards["name"])
+        hist, positions = _merge_histograms(names, [(a["cards"]["name"], a["hist"], n_decks), (b["cards"]["name"], b["hist"], other["n_decks"])])
+        # First decklist playing each qty, shifting the decklists of 'other' after those of 'state'
+        first = np.full(hist.shape, _no_deck, dtype=np.int64)
+        for part, pos, offset, n in [(a, positions[0], 0, n_decks), (b, positions[1], n_decks, other["n_decks"])]:
+            width = part["first"].shape[1]
+            shifted = np.where(part["first"] < _no_deck, part["first"] + offset, _no_deck)
+            first[pos, :width] = np.minimum(first[pos, :width], shifted)
+            # The decklists of a part do not play the cards missing from it
+            if n:
+                missing = np.ones(len(names), dtype=bool)
+                missing[pos] = False
+                first[missing, 0] = np.minimum(first[missing, 0], offset)
+        types = pd.Index(np.unique(np.concatenate([a["types"], b["types"]])))
+        types_hist, _ = _merge_histograms(types, [(a["types"], a["types_hist"], n_decks), (b["types"], b["types_hist"], other["n_decks"])])
+        merged[sb] = {"cards": cards, "hist": hist, "first": first, "types": types.to_numpy(dtype=object), "types_hist": types_hist}
+    return merged
+
+
+def _analyze_key(df, types=False):
+    # The cards attributes are columns of df, so the result does not depend on the cards database
+    return [df, types]
+
+
+@timed
+@cached(_analyze_key)
 def analyze_dls(df, types=False):
+    """Analyze the decklists of a color partition, returning df_types and df_cards (see analyze_state)
+
+    The partitions of cluster_partitions are analyzed the same way, df_cards then also has their 'cluster'.
+    """
+    df_types, df_cards = analyze_state(partition_state(df))
+    if "cluster" in df.columns:
+        df_cards.insert(1, "cluster", df["cluster"].iloc[0])
+    return df_types, df_cards
 
-    def _analyze_dls_types(df, subtypes=False):
-        
-        def _calculate_final_qty_types(x, n_decks):
-            probabilities = [
-                (x==((x.sum()/n_decks)).round(0)-2).sum() / n_decks,
-                (x==((x.sum()/n_decks)).round(0)-1).sum() / n_decks,
-                (x==((x.sum()/n_decks)).round(0)+0).sum() / n_decks,
-                (x==((x.sum()/n_decks)).round(0)+1).sum() / n_decks,
-                (x==((x.sum()/n_decks)).round(0)+2).sum() / n_decks,
-            ]
-            mean_diff = probabilities.index(max(probabilities)) - 2
-            return (x.sum()/n_decks).round(0) + mean_diff
 
+@timed
+def analyze_state(state):
+    """Compute df_types, the statistics of the total qty of each type, and df_cards, the statistics of the qty of
+    each card with the final_qty of a 60 + 15 cards decklist, from the aggregate state of a color partition"""
 
+    def _analyze_dls_types(state):
+        
         def _adjust_final_qty_types(df):
-            dfs = []
+            final_qty = df["final_qty"].copy()
             for sb, target in zip([0,1], [60,15]):
                 df_sb = df[df["sb"]==sb]
-                adj_qty = df_sb["final_qty"].sum()
-                iterations = 0
-                while (adj_qty != target) & (iterations < 100):
-                    iterations += 1
-                    for index in df_sb.index:
-                        if adj_qty > target:
-                            if df_sb.loc[index, "mean_rnd"] < df_sb.loc[index, "final_qty"]:
-                                df_sb.loc[index, "final_qty"] = df_sb.loc[index, "mean_rnd"]
-                                adj_qty = df_sb["final_qty"].sum()
-                                break
-                        else:
-                            if df_sb.loc[index, "mean_rnd"] > df_sb.loc[index, "final_qty"]:
-                                df_sb.loc[index, "final_qty"] = df_sb.loc[index, "mean_rnd"]
-                                adj_qty = df_sb["final_qty"].sum()
-                                break
-
-                if adj_qty != target:
-                    if adj_qty > target:
-                        df_sb = df_sb.sort_values(by=["diff"], ascending=True)
-                        for index in df_sb.index:
-                            df_sb.loc[index, "final_qty"] -= 1
-                            adj_qty = df_sb["final_qty"].sum()
-                            if adj_qty == target:
-                                break
-                    else:
-                        df_sb = df_sb.sort_values(by=["diff"], ascending=False)
-                        for index in df_sb.index:
-                            df_sb.loc[index, "final_qty"] += 1
-                            adj_qty = df_sb["final_qty"].sum()
-                            if adj_qty == target:
-                                break
-
-                dfs.append(df_sb)
-            df = pd.concat(dfs)
-            return df["final_qty"]
-
-
-        if subtypes:
-            group1 = df.groupby(by=["sb", "type", "subtype"], observed=True)
-        else:
-            group1 = df.groupby(by=["sb", "type"], observed=True)
-        
-        n_decks = df["#dl"].nunique()
-
-        df1 = (
-            group1["qty"].agg([lambda x: n_decks,
-                            lambda x: int(x.sum()),
-                            lambda x: (x.sum() / n_decks).round(0),
-                            lambda x: x.sum() / n_decks,
-                        ])
-                        .rename(columns={
-                            '<lambda_0>': 'n_dls',
-                            '<lambda_1>': 'sum',
-                            '<lambda_2>': 'mean_rnd',
-                            '<lambda_3>': 'mean',
-                        })
-        )
-
-        df1["diff"] = df1["mean"] - df1["mean_rnd"]
-
-        if subtypes:
-            group2 = df.groupby(by=["#dl", "sb", "type", "subtype"], observed=True)["qty"].sum()
-            group3 = group2.groupby(by=["sb", "type", "subtype"], observed=True)
-        else:
-            group2 = df.groupby(by=["#dl", "sb", "type"], observed=True)["qty"].sum()
-            group3 = group2.groupby(by=["sb", "type"], observed=True)
-
-        df2 = (group3.agg(["min", "max",
-                        lambda x: (x==((x.sum()/n_decks)).round(0)-2).sum() / n_decks,
-                        lambda x: (x==((x.sum()/n_decks)).round(0)-1).sum() / n_decks,
-                        lambda x: (x==((x.sum()/n_decks)).round(0)+0).sum() / n_decks,
-                        lambda x: (x==((x.sum()/n_decks)).round(0)+1).sum() / n_decks,
-                        lambda x: (x==((x.sum()/n_decks)).round(0)+2).sum() / n_decks,
-                        lambda x: _calculate_final_qty_types(x, n_decks),
-                        ])
-                    .rename(columns={
-                        '<lambda_0>': "% copies = mean-2",
-                        '<lambda_1>': "% copies = mean-1",
-                        '<lambda_2>': "% copies = mean",
-                        '<lambda_3>': "% copies = mean+1",
-                        '<lambda_4>': "% copies = mean+2",
-                        '<lambda_5>': "final_qty",
-                    })
-        )
-
-        
+                final_qty[df_sb.index] = allocate_final_qty(df_sb["final_qty"], target,
+                                                            preferred=df_sb["mean_rnd"],
+                                                            priority=np.arange(len(df_sb)),
+                                                            mean=df_sb["mean"],
+                                                            upper=df_sb["max"],
+                                                            label=f"sb {sb}")
+            return final_qty
+
+
+        n_decks = state["n_decks"]
+
+        # Histograms of the total qty of each (sb, type) per decklist
+        width = max(state[sb]["types_hist"].shape[1] for sb in [0, 1])
+        hist = np.vstack([np.pad(state[sb]["types_hist"], ((0, 0), (0, width - state[sb]["types_hist"].shape[1]))) for sb in [0, 1]])
+        keys = pd.DataFrame({
+            "sb": np.repeat([0, 1], [len(state[0]["types"]), len(state[1]["types"])]),
+            "type": np.concatenate([state[0]["types"], state[1]["types"]]),
+        })
+
+        sums = hist @ np.arange(width)
+        mean = sums / n_decks
+        mean_rnd = mean.round(0)
+        # Share of decklists whose total is at distance -2..+2 of the rounded mean
+        probabilities = np.zeros((5, len(hist)))
+        for i, diff in enumerate(range(-2, 3)):
+            bins = (mean_rnd + diff).astype(int)
+            valid = (bins >= 0) & (bins < width)
+            probabilities[i, valid] = hist[np.flatnonzero(valid), bins[valid]] / n_decks
+        present = hist > 0
+
+        df3 = pd.DataFrame({
+            "n_dls": n_decks,
+            "sum": sums.astype(int),
+            "mean_rnd": mean_rnd,
+            "mean": mean,
+            "diff": mean - mean_rnd,
+            "min": present.argmax(axis=1),
+            "max": width - 1 - present[:, ::-1].argmax(axis=1),
+            "% copies = mean-2": probabilities[0],
+            "% copies = mean-1": probabilities[1],
+            "% copies = mean": probabilities[2],
+            "% copies = mean+1": probabilities[3],
+            "% copies = mean+2": probabilities[4],
+            "final_qty": mean_rnd + probabilities.argmax(axis=0) - 2,
+        })
+        df3 = pd.concat([keys, df3], axis=1)
         df3 = (
-            pd.concat([df1, df2], axis=1)
-            .sort_values(
-                by=["sb", "type", "subtype", "sum"] if subtypes else ["sb", "type", "sum"],
-                ascending=[True, True, True, False] if subtypes else [True, True, False]
+            df3.sort_values(
+                by=["sb", "type", "sum"],
+                ascending=[True, True, False]
             )
-            .reset_index()
+            .reset_index(drop=True)
         )
 
         df3["final_qty"] = _adjust_final_qty_types(df3)
@@ -352,125 +479,45 @@ def analyze_dls(df, types=False):
 
 
 
-    def _analyze_dls_cards(df, types=False, types_list=None):
+    def _analyze_dls_cards(state, types=False, types_list=None):
 
-        def _calculate_final_qty_cards(x, n_decks):
-            probabilities = [
-                (x==((x.mean().round(0))-2)).sum() / n_decks,
-                (x==((x.mean().round(0))-1)).sum() / n_decks,
-                (x==((x.mean().round(0))+0)).sum() / n_decks,
-                (x==((x.mean().round(0))+1)).sum() / n_decks,
-                (x==((x.mean().round(0))+2)).sum() / n_decks,
-            ]
-            mean_diff = probabilities.index(max(probabilities)) - 2
-            return x.mean().round(0) + mean_diff
-
-        
         def _adjust_final_qty(df_orig, types_list):
             dfs = []
             for sb, type, qty in types_list:
-                df = df_orig[(df_orig["sb"]==sb) & (df_orig["type"]==type)].sort_values(by=["%_mode_2nd"], ascending=False)
-                indices = df["%_mode_2nd"].index
-                adj_qty = df["final_qty"].sum()
-                target = qty
-                iterations = 0
-                while (adj_qty != target) & (iterations < 100):
-                    iterations += 1
-                    if adj_qty > target:
-                        for index in indices:
-                            if df.loc[index, "mode_2nd"] < df.loc[index, "final_qty"]:
-                                df.loc[index, "final_qty"] = df.loc[index, "mode_2nd"]
-                                adj_qty = df["final_qty"].sum()
-                                break
-                    else:
-                        for index in indices:
-                            if df.loc[index, "mode_2nd"] > df.loc[index, "final_qty"]:
-                                df.loc[index, "final_qty"] = df.loc[index, "mode_2nd"]
-                                adj_qty = df["final_qty"].sum()
-                                break
-
-                if adj_qty != target:
-                    if adj_qty > target:
-                        df = df.sort_values(by=["diff"], ascending=True)
-                        for index in df.index:
-                            df.loc[index, "final_qty"] -= 1
-                            adj_qty = df["final_qty"].sum()
-                            if adj_qty == target:
-                                break
-                    else:
-                        df = df.sort_values(by=["diff"], ascending=False)
-                        for index in df.index:
-                            df.loc[index, "final_qty"] += 1
-                            adj_qty = df["final_qty"].sum()
-                            if adj_qty == target:
-                                break
-
+                df = df_orig[(df_orig["sb"]==sb) & (df_orig["type"]==type)].copy()
+                df["final_qty"] = allocate_final_qty(df["final_qty"], qty,
+                                                     preferred=df["mode_2nd"],
+                                                     priority=-df["%_mode_2nd"],
+                                                     mean=df["mean"],
+                                                     upper=df["max"],
+                                                     label=f"sb {sb}, type {type}")
                 dfs.append(df)
             df = pd.concat(dfs)
             return df
 
 
-        if types:
-            group1 = df.groupby(by=["sb", "type", "subtype", "name"], observed=True)
-        else:
-            group1 = df.groupby(by=["sb", "name"], observed=True)
-
-        df1 = (
-            group1["qty"].agg(["count", "sum",
-                            lambda x: x.mean().round(0).astype(int),
-                            "mean", "std",
-                            lambda x: x.value_counts().index[0] if len(x.value_counts()) > 0 else np.nan,
-                            lambda x: (x==(x.value_counts().index[0] if len(x.value_counts()) > 0 else np.nan)).sum() / df["#dl"].nunique(),
-                            lambda x: x.value_counts().index[1] if len(x.value_counts()) > 1 else np.nan,
-                            lambda x: (x==(x.value_counts().index[1] if len(x.value_counts()) > 1 else np.nan)).sum() / df["#dl"].nunique(),
-                            lambda x: x.value_counts().index[2] if len(x.value_counts()) > 2 else np.nan,
-                            lambda x: (x==(x.value_counts().index[2] if len(x.value_counts()) > 2 else np.nan)).sum() / df["#dl"].nunique(),
-                            lambda x: x.value_counts().index[3] if len(x.value_counts()) > 3 else np.nan,
-                            lambda x: (x==(x.value_counts().index[3] if len(x.value_counts()) > 3 else np.nan)).sum() / df["#dl"].nunique(),
-                            lambda x: x.value_counts().index[4] if len(x.value_counts()) > 4 else np.nan,
-                            lambda x: (x==(x.value_counts().index[4] if len(x.value_counts()) > 4 else np.nan)).sum() / df["#dl"].nunique(),
-                            "min", "max",
-                            lambda x: _calculate_final_qty_cards(x, x.count()),
-                        ])
-                        .rename(columns={
-                            'count': 'n_dls',
-                            '<lambda_0>': 'mean_rnd',
-                            '<lambda_1>': 'mode_1st',
-                            '<lambda_2>': '%_mode_1st',
-                            '<lambda_3>': 'mode_2nd',
-                            '<lambda_4>': '%_mode_2nd',
-                            '<lambda_5>': 'mode_3rd',
-                            '<lambda_6>': '%_mode_3rd',
-                            '<lambda_7>': 'mode_4th',
-                            '<lambda_8>': '%_mode_4th',
-                            '<lambda_9>': 'mode_5th',
-                            '<lambda_10>': '%_mode_5th',
-                            '<lambda_11>': 'final_qty',
-                        })
-                        # .sort_values(by=["sb", "type", "subtype", "sum", "name"] if types else ["sb", "sum", "name"],
-                        #             ascending=[True, True, True, False, True] if types else [True, False, True])
-                        .reset_index()
-        )
-
-        df1["diff"] = df1["mean"] - df1["mean_rnd"]
-
-        if types:
-            group2 = df.groupby(by=["sb", "type", "subtype", "name"], observed=True)
-        else:
-            group2 = df.groupby(by=["sb", "name"], observed=True)
-
-        df2 = (
-            group2.apply(lambda x: (x["qty"]>0).sum() / x["#dl"].nunique())
-                .reset_index()
-                .rename(columns={0: "%_dls_w_card"})
-                )
-
-        df3 = df1.merge(df2, on=["sb", "type", "subtype", "name"] if types else ["sb", "name"], how="left")
+        dfs = []
+        for sb in [0, 1]:
+            cards = state[sb]["cards"]
+            stats = card_histogram_stats(state[sb]["hist"], state[sb]["first"])
+            df1 = pd.DataFrame({"sb": sb, "type": cards["type"], "subtype": cards["subtype"], "name": cards["name"]})
+            if not types:
+                df1 = df1[["sb", "name"]]
+            df1 = df1.assign(**stats)
+            # Placeholder, final_qty is set to mode_1st and then adjusted to the types quantities
+            df1["final_qty"] = df1["mode_1st"]
+            df1["diff"] = df1["mean"] - df1["mean_rnd"]
+            # Cards without type or subtype are left out, as groupby does with missing keys
+            if types:
+                df1 = df1.dropna(subset=["type", "subtype"])
+            dfs.append(df1)
+
+        df3 = pd.concat(dfs, ignore_index=True)
         df3 = df3.sort_values(by=["sb", "type", "subtype", "sum", "name"] if types else ["sb", "sum", "name"],
                                 ascending=[True, True, True, False, True] if types else [True, False, True])
         df3 = df3.reset_index(drop=True)
 
-        df3["deck_colors"] = df["deck_colors"].unique()[0]
+        df3["deck_colors"] = state["deck_colors"]
         # df3["diff"] = df3["final_qty"] - df3["mean"]
 
         df3["final_qty"] = df3["mode_1st"]
@@ -491,11 +538,470 @@ def analyze_dls(df, types=False):
         return df3
 
 
-    df_types = _analyze_dls_types(df, subtypes=False)
+    with span("analyze_dls.types"):
+        df_types = _analyze_dls_types(state)
     sb_results, types_results, types_qty_results = df_types["sb"], df_types["type"], df_types["final_qty"]
     types_results_list = list(zip(sb_results, types_results, types_qty_results))
-    df_cards = _analyze_dls_cards(df, types=True, types_list=types_results_list)
+    with span("analyze_dls.cards"):
+        df_cards = _analyze_dls_cards(state, types=True, types_list=types_results_list)
 
     return df_types, df_cards
 
 
+
+def load_analysis_state(path):
+    """Load the aggregate states saved by update_analysis, or None if there are none"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _save_analysis_state(path, analysis):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(analysis, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+@timed
+def update_analysis(deck_name, format, rebuild=False):
+    """Analyze the decklists of an archetype incrementally, from the aggregate states of its color partitions
+
+    The states (see partition_state) are saved in the store of the archetype. Only the decklists added to the
+    store since the last update are read, processed and folded into them, then df_types and df_cards of every
+    partition are computed from the states alone, so the cost follows the number of new decklists. States keep
+    the card attributes they were folded with: after curating the cards database, pass rebuild=True to fold
+    every decklist again.
+
+    Returns a dict {deck_colors: (df_types, df_cards)}, in the same order as the dfs of process_decklists.
+    """
+    path, store = _open_store(deck_name, format)
+    state_path = os.path.join(path, store_dir, analysis_state_file)
+    analysis = None if rebuild else load_analysis_state(state_path)
+    if analysis is None:
+        analysis = {"n_decks": 0, "states": {}}
+    n_decks = len(store["decks"])
+    if n_decks > analysis["n_decks"]:
+        for df in process_decklists(_store_frame(store, start=analysis["n_decks"]), format):
+            state = partition_state(df)
+            if state["deck_colors"] in analysis["states"]:
+                state = merge_states(analysis["states"][state["deck_colors"]], state)
+            analysis["states"][state["deck_colors"]] = state
+        count("decks_folded", n_decks - analysis["n_decks"])
+        analysis["n_decks"] = n_decks
+        _save_analysis_state(state_path, analysis)
+    return {deck_colors: analyze_state(state) for deck_colors, state in analysis["states"].items()}
+
+
+def _deck_dates(path, store):
+    """Event date of each decklist of a store, from the manifest of its folder (NaT when unknown)"""
+    dates = {entry["file"]: entry.get("event_date") for entry in read_manifest(path).values()}
+    return pd.to_datetime(pd.Series([dates.get(file) for file in store["decks"]], dtype=object), errors="coerce")
+
+
+@timed
+def build_trend_index(deck_name, format, freq="M"):
+    """Index of per-period cumulative aggregates of the color partitions of an archetype, queried by trend_analysis
+
+    Decklists are grouped by the period ('W' week, 'M' month, 'Q' quarter, 'Y' year...) of the event date that
+    download_decklists records in the manifest, decklists without date are left out. For each partition and sb,
+    the index holds the prefix sums over the periods of the card qty histograms and of the types totals
+    histograms (see partition_state), and the first decklist playing each qty of each card in each period.
+    """
+    path, store = _open_store(deck_name, format)
+    dates = _deck_dates(path, store)
+    dated = dates.notna().to_numpy()
+    periods = pd.PeriodIndex(np.unique(dates[dated].dt.to_period(freq)), freq=freq)
+    deck_periods = np.full(len(dates), -1)
+    deck_periods[dated] = periods.get_indexer(dates[dated].dt.to_period(freq))
+    n_periods = len(periods)
+
+    def _prefix_sums(values):
+        return np.concatenate([np.zeros((1,) + values.shape[1:], dtype=values.dtype), np.cumsum(values, axis=0)])
+
+    df = _store_frame(store)
+    df = df[dated[df["#dl"].to_numpy()]]
+    index = {"freq": freq, "periods": periods, "partitions": {}}
+    for df_color in process_decklists(df, format):
+        matrices = build_card_matrices(df_color)
+        decks = matrices["decks"]
+        rows_periods = deck_periods[decks]
+        partition = {"n_decks": _prefix_sums(np.bincount(rows_periods, minlength=n_periods))}
+        for sb in [0, 1]:
+            matrix, cards = matrices[sb]
+            types, totals = _types_totals(matrix, cards)
+            width = int(matrix.max()) + 1 if matrix.nnz else 1
+            types_width = int(totals.max()) + 1 if totals.size else 1
+            hist = np.zeros((n_periods, len(cards), width), dtype=np.int64)
+            first = np.full((n_periods, len(cards), width), _no_deck, dtype=np.int64)
+            types_hist = np.zeros((n_periods, len(types), types_width), dtype=np.int64)
+            for period in range(n_periods):
+                rows = np.flatnonzero(rows_periods == period)
+                if not len(rows):
+                    continue
+                period_hist, period_first = card_histograms(matrix[rows])
+                hist[period, :, :period_hist.shape[1]] = period_hist
+                # First decklist as its '#dl', so that it compares across periods
+                first[period, :, :period_hist.shape[1]] = np.where(period_hist > 0, decks[rows][np.minimum(period_first, len(rows) - 1)], _no_deck)
+                period_types_hist = _columns_histogram(totals[rows])
+                types_hist[period, :, :period_types_hist.shape[1]] = period_types_hist
+            partition[sb] = {"cards": cards, "hist": _prefix_sums(hist), "first": first, "types": types, "types_hist": _prefix_sums(types_hist)}
+        index["partitions"][df_color["deck_colors"].iloc[0]] = partition
+    return index
+
+
+def _trim_histogram(hist):
+    """Drop the trailing qty columns played by no decklist"""
+    played = np.flatnonzero(hist.any(axis=0))
+    return hist[:, :played[-1] + 1 if len(played) else 1]
+
+
+def _analyze_periods(index, start, end):
+    """df_types and df_cards of each color partition over the periods start:end (positions in the index)"""
+    results = {}
+    for deck_colors, partition in index["partitions"].items():
+        n_decks = int(partition["n_decks"][end] - partition["n_decks"][start]) if end > start else 0
+        if not n_decks:
+            continue
+        state = {"deck_colors": deck_colors, "n_decks": n_decks}
+        for sb in [0, 1]:
+            aggregates = partition[sb]
+            hist = aggregates["hist"][end] - aggregates["hist"][start]
+            types_hist = aggregates["types_hist"][end] - aggregates["types_hist"][start]
+            # Only the cards and types played in the range, as in the analysis of its decklists alone
+            cards = hist[:, 1:].any(axis=1)
+            types = types_hist[:, 1:].any(axis=1)
+            hist = _trim_histogram(hist[cards])
+            # The first decklist is the only aggregate that is not a prefix sum, a minimum over the periods
+            first = aggregates["first"][start:end, cards, :hist.shape[1]].min(axis=0)
+            state[sb] = {"cards": aggregates["cards"][cards].reset_index(drop=True), "hist": hist, "first": first,
+                         "types": aggregates["types"][types], "types_hist": _trim_histogram(types_hist[types])}
+        results[deck_colors] = analyze_state(state)
+    return results
+
+
+@timed
+def trend_analysis(index, start=None, end=None):
+    """Analyze the decklists of each color partition whose event date falls from 'start' to 'end', both included
+
+    'start' and 'end' are dates or periods (e.g. '2023-05' or '2023-05-14'), an open end when None. Counts, sums
+    and histograms come from the difference of two prefixes of the index of build_trend_index, so a query costs
+    O(cards), whatever the number of decklists. Returns a dict {deck_colors: (df_types, df_cards)} of the
+    partitions with decklists in the range.
+    """
+    periods, freq = index["periods"], index["freq"]
+    start = 0 if start is None else periods.searchsorted(pd.Period(start, freq))
+    end = len(periods) if end is None else periods.searchsorted(pd.Period(end, freq), side="right")
+    return _analyze_periods(index, start, end)
+
+
+@timed
+def rolling_trends(index, window=1):
+    """df_types and df_cards over a rolling window of 'window' periods of the index, one window per period
+
+    Returns the concatenated df_types and df_cards of every window and partition, with the last period of the
+    window in a first 'period' column, e.g. to follow the mean or final_qty of a card month by month.
+    """
+    dfs_types, dfs_cards = [], []
+    for end in range(1, len(index["periods"]) + 1):
+        period = index["periods"][end - 1]
+        for deck_colors, (df_types, df_cards) in _analyze_periods(index, max(end - window, 0), end).items():
+            df_types.insert(0, "deck_colors", deck_colors)
+            df_types.insert(0, "period", period)
+            df_cards.insert(0, "period", period)
+            dfs_types.append(df_types)
+            dfs_cards.append(df_cards)
+    if not dfs_types:
+        return pd.DataFrame(), pd.DataFrame()
+    return pd.concat(dfs_types, ignore_index=True), pd.concat(dfs_cards, ignore_index=True)
+
+
+
+@timed
+def card_cooccurrence(df, top_k=10, by="lift", min_decks=1):
+    """Pairs of cards played together in the decklists of a color partition (a df of process_decklists)
+
+    Main deck and sideboard cards are the columns of a binary decklist x card inclusion matrix X, and the number
+    of decklists playing each pair of cards comes from the single sparse product X^T X. For each card A, returns
+    its 'top_k' partner cards B by 'by' ('lift', 'p_b_given_a' or 'n_ab'), among the pairs played by at least
+    'min_decks' decklists, with:
+        n_a, n_b, n_ab   number of decklists playing A, B and both
+        p_b_given_a      conditional inclusion rate P(B | A) = n_ab / n_a
+        lift             P(B | A) / P(B), above 1 when A and B are played together more often than by chance
+    """
+    from scipy.sparse import hstack
+    matrices = build_card_matrices(df)
+    n_decks = len(matrices["decks"])
+    cards = pd.concat([matrices[sb][1].assign(sb=sb) for sb in [0, 1]], ignore_index=True)
+    inclusion = hstack([matrices[sb][0] for sb in [0, 1]], format="csr")
+    inclusion.data = np.ones_like(inclusion.data)
+
+    pairs = (inclusion.T @ inclusion).tocoo()
+    n_cards = np.asarray(inclusion.sum(axis=0)).ravel()
+    a, b, n_ab = pairs.row, pairs.col, pairs.data
+    keep = (a != b) & (n_ab >= min_decks)
+    a, b, n_ab = a[keep], b[keep], n_ab[keep]
+    p_b_given_a = n_ab / n_cards[a]
+    metrics = {"n_ab": n_ab, "p_b_given_a": p_b_given_a, "lift": p_b_given_a * n_decks / n_cards[b]}
+
+    # Top k partners of each card: sort by card and decreasing metric, then keep the first k of each card
+    order = np.lexsort((b, -metrics[by], a))
+    a, b = a[order], b[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(a)) + 1]
+    rank = np.arange(len(a)) - np.repeat(starts, np.diff(np.r_[starts, len(a)]))
+    top = order[rank < top_k]
+    a, b = pairs.row[keep][top], pairs.col[keep][top]
+
+    df_pairs = pd.DataFrame({
+        "deck_colors": df["deck_colors"].iloc[0],
+        "sb_a": cards["sb"].to_numpy()[a],
+        "name_a": cards["name"].to_numpy()[a],
+        "sb_b": cards["sb"].to_numpy()[b],
+        "name_b": cards["name"].to_numpy()[b],
+        "n_a": n_cards[a],
+        "n_b": n_cards[b],
+        "n_ab": metrics["n_ab"][top],
+        "p_b_given_a": metrics["p_b_given_a"][top],
+        "lift": metrics["lift"][top],
+    })
+    return df_pairs
+
+
+def _resampled_histograms(onehot, pairs, weights, n_columns, width):
+    """Histograms (n_resamples, n_columns, width) of the values of each column under each resample of the decklists
+
+    'onehot' is the decklists x (column, value) indicator matrix of the nonzero values, whose (column, value)
+    pairs are encoded as column * width + value in 'pairs', and 'weights' the n_resamples x decklists number of
+    times each decklist is drawn in each resample. Counts of value 0 are the decklists left.
+    """
+    counts = (onehot.T @ weights.T).T
+    hist = np.zeros((len(weights), n_columns, width))
+    hist[:, pairs // width, pairs % width] = counts
+    hist[:, :, 0] = weights.sum(axis=1)[:, None] - hist[:, :, 1:].sum(axis=2)
+    return hist
+
+
+def _onehot(rows, columns, values, n_rows, width):
+    """Indicator matrix of the (column, value) pairs of each row, and the pairs encoded as column * width + value"""
+    from scipy.sparse import csr_matrix
+    pairs, pairs_ids = np.unique(columns.astype(np.int64) * width + values, return_inverse=True)
+    return csr_matrix((np.ones(len(rows)), (rows, pairs_ids)), shape=(n_rows, len(pairs))), pairs
+
+
+@timed
+def bootstrap_analysis(df, n_resamples=1000, confidence=0.95, seed=0, batch_size=None):
+    """Bootstrap the card statistics of a color partition (a df of process_decklists) over resamples of its decklists
+
+    Decklists are drawn with replacement 'n_resamples' times, all at once as a resamples x decklists matrix W of
+    draw counts, and the statistics of every resample come from batched matrix products: W @ X for the card qty
+    sums and W @ one-hot indicators for the qty histograms, from which the modes, types totals and final_qty of
+    each resample are computed as in analyze_dls (only the final_qty allocation loops over the resamples, ties
+    being broken as in the whole partition). Resamples are processed by batches of 'batch_size' (by default
+    about 5 million draws counts per batch) to bound memory.
+
+    Returns df_cards of analyze_dls with the 'confidence' percentile intervals of the mean ('mean_low',
+    'mean_high') and of the share of decklists playing the card ('%_dls_w_card_low', '%_dls_w_card_high'),
+    and 'final_qty_change_rate', the share of resamples in which the final_qty of the card differs.
+    """
+    df_types, df_cards = analyze_dls(df)
+    df_cards = df_cards.reset_index(drop=True)
+    matrices = build_card_matrices(df)
+    n_decks = len(matrices["decks"])
+    rng = np.random.default_rng(seed)
+    batch_size = batch_size or max(1, 5_000_000 // n_decks)
+
+    # Fixed over the resamples: the one-hot indicators of the card qtys and types totals of each sb, the first
+    # decklist playing each qty (to break the ties of the modes) and the rows of the cards of df_cards
+    sbs = {}
+    for sb in [0, 1]:
+        matrix, cards = matrices[sb]
+        coo = matrix.tocoo()
+        width = int(coo.data.max()) + 1 if coo.nnz else 1
+        types, totals = _types_totals(matrix, cards)
+        types_rows, types_columns = np.nonzero(totals)
+        types_width = int(totals.max()) + 1 if totals.size else 1
+        df_sb = df_cards[df_cards["sb"] == sb]
+        sbs[sb] = {
+            "n_cards": len(cards), "width": width, "first": card_histograms(matrix)[1],
+            "onehot": _onehot(coo.row, coo.col, coo.data, n_decks, width),
+            "types": types, "types_width": types_width,
+            "types_onehot": _onehot(types_rows, types_columns, totals[types_rows, types_columns], n_decks, types_width),
+            # Positions of the cards of df_cards in the matrix columns, and in df_cards, by type
+            "groups": {type: (pd.Index(cards["name"]).get_indexer(df_type["name"]), df_type.index.to_numpy())
+                       for type, df_type in df_sb.groupby("type", sort=False)},
+        }
+
+    means = np.zeros((n_resamples, len(df_cards)))
+    inclusion = np.zeros((n_resamples, len(df_cards)))
+    final_qty = np.zeros((n_resamples, len(df_cards)))
+    # Targets some resamples cannot reach within the qty bounds are expected, their warnings are left out
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for batch_start in range(0, n_resamples, batch_size):
+            batch = slice(batch_start, min(batch_start + batch_size, n_resamples))
+            weights = rng.multinomial(n_decks, np.full(n_decks, 1 / n_decks), size=batch.stop - batch.start)
+
+            types_final_qty = {}
+            cards_stats = {}
+            for sb, target in zip([0, 1], [60, 15]):
+                aggregates = sbs[sb]
+                # Types totals, final_qty as in _analyze_dls_types
+                hist = _resampled_histograms(aggregates["types_onehot"][0], aggregates["types_onehot"][1], weights,
+                                             len(aggregates["types"]), aggregates["types_width"])
+                mean = hist @ np.arange(aggregates["types_width"]) / n_decks
+                mean_rnd = mean.round(0)
+                probabilities = np.zeros((5,) + mean.shape)
+                for i, diff in enumerate(range(-2, 3)):
+                    bins = (mean_rnd + diff).astype(int)
+                    valid = (bins >= 0) & (bins < aggregates["types_width"])
+                    probabilities[i] = np.where(valid, np.take_along_axis(hist, np.clip(bins, 0, aggregates["types_width"] - 1)[..., None], axis=2)[..., 0], 0)
+                types_max = aggregates["types_width"] - 1 - (hist > 0)[:, :, ::-1].argmax(axis=2)
+                types_final = mean_rnd + probabilities.argmax(axis=0) - 2
+                for b in range(len(weights)):
+                    types_final[b] = allocate_final_qty(types_final[b], target, preferred=mean_rnd[b],
+                                                        priority=np.arange(len(aggregates["types"])), mean=mean[b],
+                                                        upper=types_max[b])
+                types_final_qty[sb] = dict(zip(aggregates["types"], types_final.T))
+
+                # Card statistics, modes ranked by decreasing count and then by first decklist
+                hist = _resampled_histograms(aggregates["onehot"][0], aggregates["onehot"][1], weights,
+                                             aggregates["n_cards"], aggregates["width"])
+                key = hist * (n_decks + 1) - aggregates["first"]
+                mode_1st = key.argmax(axis=2)
+                np.put_along_axis(key, mode_1st[..., None], -np.inf, axis=2)
+                mode_2nd = key.argmax(axis=2)
+                count_2nd = np.take_along_axis(hist, mode_2nd[..., None], axis=2)[..., 0]
+                cards_stats[sb] = {
+                    "mean": hist @ np.arange(aggregates["width"]) / n_decks,
+                    "inclusion": 1 - hist[:, :, 0] / n_decks,
+                    "mode_1st": mode_1st,
+                    "mode_2nd": np.where(count_2nd > 0, mode_2nd, np.nan),
+                    "%_mode_2nd": count_2nd / n_decks,
+                    "max": aggregates["width"] - 1 - (hist > 0)[:, :, ::-1].argmax(axis=2),
+                }
+
+            # Final qty of the cards of each type adjusted to the final qty of the type, as in _analyze_dls_cards
+            for sb in [0, 1]:
+                stats = cards_stats[sb]
+                for type, (columns, rows) in sbs[sb]["groups"].items():
+                    means[batch, rows] = stats["mean"][:, columns]
+                    inclusion[batch, rows] = stats["inclusion"][:, columns]
+                    targets = types_final_qty[sb].get(type)
+                    for b in range(len(weights)):
+                        final_qty[batch.start + b, rows] = allocate_final_qty(
+                            stats["mode_1st"][b, columns], targets[b] if targets is not None else 0,
+                            preferred=stats["mode_2nd"][b, columns], priority=-stats["%_mode_2nd"][b, columns],
+                            mean=stats["mean"][b, columns], upper=stats["max"][b, columns])
+
+    alpha = (1 - confidence) / 2
+    df_cards["mean_low"], df_cards["mean_high"] = np.quantile(means, [alpha, 1 - alpha], axis=0)
+    df_cards["%_dls_w_card_low"], df_cards["%_dls_w_card_high"] = np.quantile(inclusion, [alpha, 1 - alpha], axis=0)
+    df_cards["final_qty_change_rate"] = (final_qty != df_cards["final_qty"].to_numpy()).mean(axis=0)
+    return df_cards
+
+
+
+@timed
+def cluster_partitions(dfs, threshold=0.6, min_size=2, num_perm=128):
+    """Split the decklists of an archetype by variant instead of by color, as an alternative to the color
+    partitions of process_decklists
+
+    Decklists (of all the dfs of process_decklists) are clustered by the similarity of their cards with MinHash
+    signatures and LSH (see decklist_similarity.cluster_decklists), which takes seconds for 50k decklists.
+    Returns one df per cluster of at least 'min_size' decklists, by decreasing size, the smaller clusters being
+    pooled into a last df of cluster -1. Each df has a 'cluster' column and, as 'deck_colors', the colors played
+    by its decklists, so analyze_dls takes it as a color partition.
+    """
+    df = pd.concat(dfs, ignore_index=True).sort_values("#dl", kind="stable", ignore_index=True)
+    decks, rows = np.unique(df["#dl"].to_numpy(), return_inverse=True)
+    card_ids, names = pd.factorize(df["name"])
+    signatures = minhash_signatures(np.r_[0, np.cumsum(np.bincount(rows, minlength=len(decks)))], card_ids,
+                                    df["qty"].to_numpy(), df["sb"].to_numpy(), names, num_perm=num_perm)
+    labels = cluster_decklists(signatures, threshold)
+    labels[np.bincount(labels)[labels] < min_size] = -1
+    df.insert(2, "cluster", labels[rows])
+
+    dfs_cluster = []
+    for label in sorted(np.unique(labels), key=lambda label: label < 0):
+        df_cluster = df[df["cluster"] == label].reset_index(drop=True)
+        colors = set("".join(pd.unique(df_cluster["deck_colors"])))
+        df_cluster["deck_colors"] = "".join(c for c in "WUBRG" if c in colors)
+        dfs_cluster.append(df_cluster)
+    count("partitions", len(dfs_cluster))
+    return dfs_cluster
+
+
+def _process_task(deck_name, format):
+    return process_decklists(read_decklists(deck_name, format), format)
+
+
+def analyze_batch(decks, max_workers=None, output_dir=None):
+    """Read, process and analyze the decklists of several (deck_name, format) pairs on a pool of processes
+
+    Each archetype is processed in a task and each of its color partitions analyzed in another one, so the work
+    spreads over all the cores. The new cards of all the archetypes are added to the cards database up front, so
+    the workers only read it. A failing archetype or partition (e.g. a malformed decklists folder) does not stop
+    the batch, its error is returned instead.
+
+    Returns a list of dicts with keys 'deck_name', 'format', 'deck_colors', 'df_types', 'df_cards' and 'error'.
+    If 'output_dir' is given, df_types and df_cards are also saved as csv files to
+    '<output_dir>/<format>/<deck>/<deck_colors>_types.csv' and '..._cards.csv'.
+    """
+
+    def _result(deck_name, format, deck_colors=None, df_types=None, df_cards=None, error=None):
+        return {"deck_name": deck_name, "format": format, "deck_colors": deck_colors,
+                "df_types": df_types, "df_cards": df_cards, "error": error}
+
+    results = []
+
+    # Add the new cards of every archetype to the cards database, so that workers do not write to it
+    names = {}
+    for deck_name, format in decks:
+        try:
+            df = read_decklists(deck_name, format)
+            names.setdefault(format.lower().replace(" ", "_"), set()).update(df["name"].unique())
+        except Exception as e:
+            results.append(_result(deck_name, format, error=repr(e)))
+    failed = {(result["deck_name"], result["format"]) for result in results}
+    for format, format_names in names.items():
+        add_missing_cards(format, list(format_names))
+        load_cards_db(format)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        process_futures = {executor.submit(_process_task, deck_name, format): (deck_name, format)
+                           for deck_name, format in decks if (deck_name, format) not in failed}
+        analyze_futures = {}
+        progress("start", "batch_process", f"Processing {len(process_futures)} archetypes...")
+        for i, future in enumerate(as_completed(process_futures)):
+            deck_name, format = process_futures[future]
+            progress("progress", "batch_process", f"Processed {i+1}/{len(process_futures)}: {deck_name} ({format})...",
+                     current=i+1, total=len(process_futures))
+            if future.exception() is not None:
+                results.append(_result(deck_name, format, error=repr(future.exception())))
+                continue
+            for df in future.result():
+                deck_colors = df["deck_colors"].iloc[0]
+                analyze_futures[executor.submit(analyze_dls, df)] = (deck_name, format, deck_colors)
+        progress("done", "batch_process")
+        progress("start", "batch_analyze", f"Analyzing {len(analyze_futures)} color partitions...")
+        for i, future in enumerate(as_completed(analyze_futures)):
+            deck_name, format, deck_colors = analyze_futures[future]
+            progress("progress", "batch_analyze", f"Analyzed {i+1}/{len(analyze_futures)}: {deck_name} ({format}) {deck_colors}...",
+                     current=i+1, total=len(analyze_futures))
+            if future.exception() is not None:
+                results.append(_result(deck_name, format, deck_colors, error=repr(future.exception())))
+                continue
+            df_types, df_cards = future.result()
+            results.append(_result(deck_name, format, deck_colors, df_types, df_cards))
+        progress("done", "batch_analyze")
+
+    if output_dir is not None:
+        for result in results:
+            if result["error"] is None:
+                path = os.path.join(output_dir, result["format"].lower().replace(" ", "_"), result["deck_name"].lower().replace(" ", "_"))
+                os.makedirs(path, exist_ok=True)
+                result["df_types"].to_csv(os.path.join(path, f"{result['deck_colors'] or 'C'}_types.csv"), index=False)
+                result["df_cards"].to_csv(os.path.join(path, f"{result['deck_colors'] or 'C'}_cards.csv"), index=False)
+
+    return results
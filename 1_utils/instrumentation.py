@@ -0,0 +1,227 @@
+"""Instrumentation of the pipeline: progress events, timing spans, counters and optional profiling
+
+Progress events are always sent to the registered callbacks, by default 'print_progress', which prints them as
+the downloader always did. Spans and counters are only recorded once enabled, when disabled they cost a single
+check of a flag:
+
+    import instrumentation
+    with instrumentation.capture("metrics.jsonl", trace_memory=True):
+        df = read_decklists("Devourer Combo", "Premodern")
+    print(instrumentation.summary())
+
+Metrics are kept per process, those of the workers of a process pool are not collected.
+"""
+import json
+import time
+import pstats
+import cProfile
+import threading
+import functools
+import tracemalloc
+from io import StringIO
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+enabled = False
+trace_memory = False
+# Spans and counters aggregated by name, and the records of every span and event for the json lines export
+spans = {}
+counters = {}
+records = []
+# Functions called with every progress event
+callbacks = []
+
+_lock = threading.Lock()
+_profiler = None
+# [memory at start, peak so far] of the spans in progress, outermost first. Spans are only opened by the main
+# thread, worker threads just update counters
+_stack = []
+
+
+def print_progress(event):
+    """Default progress callback, prints the events on the console"""
+    if event["kind"] == "progress":
+        print(f"\r\t{event['message']}", end="")
+    elif event["kind"] == "done":
+        print(f"\r\t{event['message'] or 'Done!'}\n")
+    else:
+        print(event["message"])
+
+
+callbacks.append(print_progress)
+
+
+def add_callback(callback):
+    """Register a function called with the dict of every progress event"""
+    callbacks.append(callback)
+
+
+def remove_callback(callback):
+    callbacks.remove(callback)
+
+
+def progress(kind, stage, message="", **fields):
+    """Send a progress event to the callbacks
+
+    'kind' is 'start', 'progress' (e.g. with 'current' and 'total' fields), 'done' or 'info'. While enabled, the
+    events other than 'progress' are also recorded, the counters already account for the items processed.
+    """
+    event = {"kind": kind, "stage": stage, "message": message, **fields}
+    for callback in callbacks:
+        callback(event)
+    if enabled and kind != "progress":
+        records.append({"type": "event", "ts": _now(), **event})
+
+
+def count(name, n=1):
+    """Add n to a counter, e.g. pages fetched or bytes downloaded"""
+    if not enabled:
+        return
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        if trace_memory:
+            current = _update_peaks()
+            tracemalloc.reset_peak()
+            _stack.append([current, current])
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        peak = 0
+        if trace_memory and _stack:
+            _update_peaks()
+            start_memory, peak = _stack.pop()
+            peak -= start_memory
+        record = spans.setdefault(self.name, {"calls": 0, "wall_s": 0.0, "peak_mb": 0.0})
+        record["calls"] += 1
+        record["wall_s"] += wall
+        record["peak_mb"] = max(record["peak_mb"], peak / 2**20)
+        records.append({"type": "span", "ts": _now(), "name": self.name, "wall_s": wall, "peak_mb": peak / 2**20,
+                        "depth": len(_stack), **self.fields})
+        return False
+
+
+def _update_peaks():
+    """Fold the traced peak into the spans in progress, before it is reset or read"""
+    current, peak = tracemalloc.get_traced_memory()
+    for frame in _stack:
+        frame[1] = max(frame[1], peak)
+    return current
+
+
+def span(name, **fields):
+    """Context manager timing a block (and its peak memory when tracing memory) under 'name'"""
+    if not enabled:
+        return _null_span
+    return _Span(name, fields)
+
+
+def timed(func):
+    """Decorator timing every call of a function as a span named after it"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        with _Span(func.__name__, {}):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def enable(profile=False, memory=False):
+    """Start recording spans and counters, optionally under cProfile and tracing memory with tracemalloc"""
+    global enabled, trace_memory, _profiler
+    enabled = True
+    trace_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if profile:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def disable():
+    """Stop recording, the metrics recorded so far are kept until reset"""
+    global enabled, trace_memory
+    if _profiler is not None:
+        _profiler.disable()
+    if trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _stack.clear()
+    enabled = False
+    trace_memory = False
+
+
+def reset():
+    """Clear the recorded spans, counters, records and profile"""
+    global _profiler
+    spans.clear()
+    counters.clear()
+    records.clear()
+    _profiler = None
+
+
+@contextmanager
+def capture(path=None, profile=False, memory=False):
+    """Record the metrics of a block, appending them to the json lines file 'path' if given"""
+    reset()
+    enable(profile=profile, memory=memory)
+    try:
+        yield
+    finally:
+        disable()
+        if path is not None:
+            export_jsonl(path)
+
+
+def summary():
+    """Spans and counters recorded so far, as a dict"""
+    return {"spans": {name: dict(record) for name, record in spans.items()}, "counters": dict(counters)}
+
+
+def export_jsonl(path):
+    """Append the span and event records, then the final value of each counter, to a json lines file"""
+    ts = _now()
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+        for name, value in counters.items():
+            f.write(json.dumps({"type": "counter", "ts": ts, "name": name, "value": value}) + "\n")
+
+
+def profile_stats(sort="cumulative", limit=30, path=None):
+    """Report of the cProfile capture as text, saving the raw stats to 'path' if given"""
+    if _profiler is None:
+        return ""
+    if path is not None:
+        _profiler.dump_stats(path)
+    stream = StringIO()
+    pstats.Stats(_profiler, stream=stream).sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
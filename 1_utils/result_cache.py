@@ -0,0 +1,113 @@
+import os
+import glob
+import pickle
+import hashlib
+import functools
+import threading
+import pandas as pd
+from instrumentation import count
+
+
+# Content-addressed cache of the results of the pipeline functions, one pickle file per result named after the
+# hash of the function inputs. Files are evicted by least recent use once the cache exceeds 'max_size' bytes.
+cache_dir = os.path.join("0_data", "cache")
+max_size = 1024**3
+enabled = True
+
+# Hash of the source code of the pipeline, so that results computed by another version are never returned
+_code_version = None
+
+
+def _get_code_version():
+    global _code_version
+    if _code_version is None:
+        sha = hashlib.sha256()
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))):
+            with open(path, "rb") as f:
+                sha.update(f.read())
+        _code_version = sha.hexdigest()
+    return _code_version
+
+
+def hash_inputs(*parts):
+    """Hash of the inputs of a function: DataFrames by content (columns, dtypes and values), anything else by repr"""
+    sha = hashlib.sha256(_get_code_version().encode())
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            sha.update(repr((list(part.columns), [str(dtype) for dtype in part.dtypes], part.shape)).encode())
+            sha.update(pd.util.hash_pandas_object(part, index=False).to_numpy().tobytes())
+        else:
+            sha.update(repr(part).encode())
+        # Separator, so that consecutive parts cannot be confused
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def cached(key_func):
+    """Decorator caching the results of a function on disk
+
+    'key_func' is called with the arguments of each call and returns the list of its inputs (DataFrames,
+    strings, versions...), hashed together with the function name into the key of the result.
+    """
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            path = os.path.join(cache_dir, f"{func.__name__}_{hash_inputs(func.__name__, *key_func(*args, **kwargs))}.pkl")
+            try:
+                with open(path, "rb") as f:
+                    result = pickle.load(f)
+                # Mark the file as recently used
+                os.utime(path)
+                count("cache_hits")
+                return result
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+            count("cache_misses")
+            result = func(*args, **kwargs)
+            _save(path, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _save(path, result):
+    """Save a result atomically, so that concurrent processes never read a partial file, then evict old files"""
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    evict()
+
+
+def evict(size=None):
+    """Delete the least recently used results until the cache takes at most 'size' bytes (max_size by default)"""
+    size = max_size if size is None else size
+    files = []
+    for entry in os.scandir(cache_dir) if os.path.exists(cache_dir) else []:
+        if entry.name.endswith(".pkl"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(file_size for _, file_size, _ in files)
+    for _, file_size, path in sorted(files):
+        if total <= size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= file_size
+
+
+def clear():
+    """Delete every cached result"""
+    evict(0)